@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks.py
+agent, 18/10/26
+Benchmarks of the ray-tracer on the task scripts' optical systems at
+scaled numbers of rays, reporting rays per second, peak memory and the
+time of each stage, and checking the results against a stored baseline
+
+Usage:
+    python benchmarks.py                              # 10^3 to 10^6 rays
+    python benchmarks.py --rays 1e3 1e7 --output results.json
+    python benchmarks.py --baseline baseline.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import raytracer as rt
+import optical_elements as oe
+import optical_system as osys
+import paraxial as px
+import rms_objective as ro
+import spot_statistics as ss
+
+
+def scaled_bundle(radius, n_rays):
+    """
+    Function that makes a beam of about n_rays rays filling a circle
+    evenly, in rings with a number of rays proportional to their radius
+
+    Parameters
+    ----------
+    radius: radius of the beam
+
+    n_rays: number of rays wanted
+
+    Returns
+    -------
+    bundle: Bundle object for a collimated beam along the z-axis
+    """
+
+    n_rings = max(int(np.sqrt(n_rays / np.pi)), 1)
+    r = np.linspace(0, radius, n_rings + 1)
+
+    # the centre ray, then about 2*pi*i rays in ring i
+    n = np.maximum(np.rint(np.arange(n_rings + 1) *
+                           (n_rays - 1) / (n_rings*(n_rings + 1)/2)), 1)
+
+    return rt.Bundle(r, n.astype(int), 0, [0, 0, 1])
+
+
+def single_surface():
+    """
+    Function for the convex surface of tests_tasks_12-14.py,
+    with the output plane at the paraxial focus
+
+    Returns
+    -------
+    list of optical elements, beam radius
+    """
+
+    surf = oe.SphericalRefraction(
+        z0=[0, 0, 100], curv=0.03, n1=1, n2=1.5, ap_rad=100)
+
+    return [surf, oe.OutputPlane(px.ParaxialSystem([surf]).focus())], 5
+
+
+def plano_convex(convex_first):
+    """
+    Function for the plano-convex singlet of task15_plano_convex.py,
+    with the output plane at the paraxial focus
+
+    Parameters
+    ----------
+    convex_first: if True, the convex surface faces the input
+
+    Returns
+    -------
+    list of optical elements, beam radius
+    """
+
+    if convex_first:
+        curvs = (0.02, 0)
+    else:
+        curvs = (0, -0.02)
+
+    surfs = [oe.SphericalRefraction(z0=[0, 0, 100], curv=curvs[0], n1=1,
+                                    n2=1.5168, ap_rad=100),
+             oe.SphericalRefraction(z0=[0, 0, 105], curv=curvs[1],
+                                    n1=1.5168, n2=1, ap_rad=100)]
+
+    return surfs + [oe.OutputPlane(px.ParaxialSystem(surfs).focus())], 5
+
+
+def trace_workload(elems, radius, n_rays):
+    """
+    Function that builds, traces and analyses a beam, timing each stage
+
+    Parameters
+    ----------
+    elems: list of optical elements
+
+    radius: radius of the beam
+
+    n_rays: number of rays wanted
+
+    Returns
+    -------
+    stages: dictionary of the time of each stage, in seconds
+
+    n: number of rays traced
+
+    rms: RMS spot radius at the output plane, to check the results
+    """
+
+    stages = {}
+
+    t = time.perf_counter()
+    system = osys.OpticalSystem(elems)
+    bundle = scaled_bundle(radius, n_rays)
+    batch = bundle.create_batch(history=False)
+    stages['build'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    system.trace(batch)
+    stages['trace'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    rms = ss.SpotStatistics().add(batch).rms()
+    stages['analyse'] = time.perf_counter() - t
+
+    return stages, len(batch), rms
+
+
+def objective_workload(n_rays):
+    """
+    Function that evaluates the RMS objective of lens_optimization.py
+    and its gradient at the plano-convex starting curvatures,
+    timing each stage
+
+    Parameters
+    ----------
+    n_rays: number of rays wanted
+
+    Returns
+    -------
+    stages: dictionary of the time of each stage, in seconds
+
+    n: number of rays traced
+
+    rms: RMS spot radius of the starting design, to check the results
+    """
+
+    stages = {}
+
+    t = time.perf_counter()
+    elems = [oe.SphericalRefraction(z0=[0, 0, 100], curv=0.02, n1=1,
+                                    n2=1.5168, ap_rad=100),
+             oe.SphericalRefraction(z0=[0, 0, 105], curv=-0.02, n1=1.5168,
+                                    n2=1, ap_rad=100),
+             oe.OutputPlane(z=198.45)]
+    bundle = scaled_bundle(5, n_rays)
+    objective = ro.RmsObjective(osys.OpticalSystem(elems), bundle)
+    stages['build'] = time.perf_counter() - t
+
+    x0 = np.array([0.02, -0.02])
+
+    t = time.perf_counter()
+    rms = objective(x0)
+    stages['evaluate'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    objective.value_and_grad(x0)
+    stages['gradient'] = time.perf_counter() - t
+
+    return stages, len(objective._p0), rms
+
+
+WORKLOADS = {
+    'single_surface': lambda n: trace_workload(*single_surface(), n),
+    'plano_convex_plane_first': lambda n: trace_workload(
+        *plano_convex(False), n),
+    'plano_convex_convex_first': lambda n: trace_workload(
+        *plano_convex(True), n),
+    'lens_objective': objective_workload,
+}
+
+
+def run(name, n_rays, repeat):
+    """
+    Function that runs a workload several times, keeping the fastest time
+    of each stage, then once more to measure the peak memory
+
+    Parameters
+    ----------
+    name: name of the workload in WORKLOADS
+
+    n_rays: number of rays wanted
+
+    repeat: number of timed runs
+
+    Returns
+    -------
+    dictionary of the results
+    """
+
+    best = {}
+
+    for i in range(repeat):
+        # so every run generates the beam layout rather than reusing it
+        rt.clear_layout_cache()
+
+        stages, n, rms = WORKLOADS[name](n_rays)
+
+        for stage, seconds in stages.items():
+            best[stage] = min(best.get(stage, np.inf), seconds)
+
+    # numpy reports its allocations to tracemalloc, which slows the run,
+    # so it is only switched on for a separate run
+    rt.clear_layout_cache()
+    tracemalloc.start()
+    WORKLOADS[name](n_rays)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    total = sum(best.values())
+
+    return {'workload': name, 'n_rays': int(n), 'stages': best,
+            'total': total, 'rays_per_s': n / total,
+            'peak_mb': peak / 2**20, 'rms': float(rms)}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Function that finds the results slower than a baseline by more than
+    the tolerance, or whose RMS spot radius has changed
+
+    Parameters
+    ----------
+    results: list of result dictionaries
+
+    baseline: list of result dictionaries from an earlier run
+
+    tolerance: fraction by which the rays per second may drop
+
+    Returns
+    -------
+    list of messages describing each regression
+    """
+
+    old = {(r['workload'], r['n_rays']): r for r in baseline}
+    regressions = []
+
+    for new in results:
+        key = (new['workload'], new['n_rays'])
+
+        if key not in old:
+            continue
+
+        ratio = new['rays_per_s'] / old[key]['rays_per_s']
+
+        if ratio < 1 - tolerance:
+            regressions.append('%s with %d rays: %.3g rays/s, %.0f%% of the'
+                               ' baseline' % (key + (new['rays_per_s'],
+                                                     100*ratio)))
+
+        if not np.isclose(new['rms'], old[key]['rms'], rtol=1e-9):
+            regressions.append('%s with %d rays: RMS changed from %.9g to'
+                               ' %.9g' % (key + (old[key]['rms'],
+                                                 new['rms'])))
+
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the ray-tracer at scaled numbers of rays')
+    parser.add_argument('--rays', type=float, nargs='+',
+                        default=[1e3, 1e4, 1e5, 1e6],
+                        help='numbers of rays to trace in each workload')
+    parser.add_argument('--workloads', nargs='+', default=list(WORKLOADS),
+                        choices=list(WORKLOADS))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs, the fastest is kept')
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--baseline', help='results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction the rays per second may drop by')
+    args = parser.parse_args(argv)
+
+    results = []
+
+    print('%-26s %9s %12s %9s  %s' % ('workload', 'rays', 'rays/s',
+                                      'peak MB', 'stages (s)'))
+
+    for name in args.workloads:
+        for n_rays in args.rays:
+            result = run(name, int(n_rays), args.repeat)
+            results.append(result)
+
+            stages = ', '.join('%s %.3g' % item
+                               for item in result['stages'].items())
+            print('%-26s %9d %12.4g %9.1f  %s'
+                  % (name, result['n_rays'], result['rays_per_s'],
+                     result['peak_mb'], stages))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'machine': platform.platform(),
+                       'results': results}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, args.tolerance)
+
+        for message in regressions:
+            print('REGRESSION:', message)
+
+        if regressions:
+            return 1
+
+        print('No regressions against', args.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
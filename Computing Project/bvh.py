@@ -0,0 +1,451 @@
+"""
+bvh.py
+agent, 18/10/26
+Module for a bounding volume hierarchy over the surfaces of an optical
+system, so each ray in a batch is only tested against the surfaces it
+could hit when finding its nearest intercept
+"""
+
+import numpy as np
+import raytracer as rt
+import optical_elements as oe
+import optical_system as osys
+
+# smallest distance to a hit, so rays starting on a surface
+# do not find it again straight away
+T_MIN = 1e-9
+
+
+def surface_bounds(system):
+    """
+    Function that finds an axis-aligned bounding box around each surface
+    of a system, covering the cap of a spherical surface about its vertex
+    out to the aperture radius (or to its rim if the aperture is wider),
+    and the whole of an output plane or stop
+
+    Parameters
+    ----------
+    system: OpticalSystem object
+
+    Returns
+    -------
+    lo: (S, 3) array of the lower corner of each box
+
+    hi: (S, 3) array of the upper corner of each box
+    """
+
+    curv = system._curv
+    z0 = system._z0
+
+    with np.errstate(divide='ignore'):
+        radius = np.where(curv != 0, 1 / np.abs(curv), np.inf)
+
+    # lateral extent of the cap, and the sag of its edge,
+    # stops are as wide as planes since they block the rays around them
+    rho = np.where(system._kind == osys.STOP, np.inf,
+                   np.minimum(system._ap_rad, radius))
+
+    with np.errstate(invalid='ignore'):
+        sag = np.where(curv != 0,
+                       (1 - np.sqrt(np.maximum(1 - (curv*rho)**2, 0))) / curv,
+                       0)
+
+    half = np.stack((rho, rho, np.zeros(len(curv))), axis=-1)
+    lo = z0 - half
+    hi = z0 + half
+    lo[:, 2] += np.minimum(sag, 0)
+    hi[:, 2] += np.maximum(sag, 0)
+
+    # padding so rounding cannot push a hit just outside its box
+    pad = 1e-9 * (1 + np.abs(z0))
+
+    return lo - pad, hi + pad
+
+
+def box_distance(p, k_hat, lo, hi, t_min=T_MIN):
+    """
+    Function that finds how far along rays they enter an axis-aligned box
+    (slab method)
+
+    Parameters
+    ----------
+    p: (N, 3) array of start points of the rays
+
+    k_hat: (N, 3) array of unit direction vectors of the rays
+
+    lo, hi: 1D arrays for the lower and upper corners of the box
+
+    t_min: smallest distance along the rays counted as ahead of them
+
+    Returns
+    -------
+    array of the distance along each ray to where it enters the box,
+    t_min if it starts inside, inf for rays not passing through it ahead
+    """
+
+    inside = (p >= lo) & (p <= hi)  # for rays parallel to a slab
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_1 = (lo - p) / k_hat
+        t_2 = (hi - p) / k_hat
+
+    parallel = k_hat == 0
+
+    t_near = np.where(parallel, np.where(inside, -np.inf, np.inf),
+                      np.minimum(t_1, t_2)).max(axis=-1)
+    t_far = np.where(parallel, np.where(inside, np.inf, -np.inf),
+                     np.maximum(t_1, t_2)).min(axis=-1)
+
+    t_near = np.maximum(t_near, t_min)
+
+    return np.where(t_far >= t_near, t_near, np.inf)
+
+
+def box_hit(p, k_hat, lo, hi, t_min=T_MIN):
+    """
+    Function that tests rays against an axis-aligned box (slab method)
+
+    Parameters
+    ----------
+    p: (N, 3) array of start points of the rays
+
+    k_hat: (N, 3) array of unit direction vectors of the rays
+
+    lo, hi: 1D arrays for the lower and upper corners of the box
+
+    t_min: smallest distance along the rays counted as ahead of them
+
+    Returns
+    -------
+    boolean array of the rays passing through the box ahead of them
+    """
+
+    return box_distance(p, k_hat, lo, hi, t_min) < np.inf
+
+
+class SurfaceBVH:
+    """
+    Class for a bounding volume hierarchy over the surfaces of an optical
+    system, a binary tree of boxes each enclosing the boxes of its children
+    """
+
+    def __init__(self, system, leaf_size=2):
+        """
+        Parameters
+        ----------
+        system: OpticalSystem object, or list of optical elements
+
+        leaf_size: largest number of surfaces in a leaf of the tree
+        """
+
+        if not isinstance(system, osys.OpticalSystem):
+            system = osys.OpticalSystem(system)
+
+        self._system = system
+        self._leaf_size = max(leaf_size, 1)
+
+        self._surf_lo, self._surf_hi = surface_bounds(system)
+
+        # nodes of the tree, the root first
+        self._lo = []
+        self._hi = []
+        self._children = []  # (left, right) indices, or None for a leaf
+        self._surfaces = []  # surfaces in each leaf
+
+        self._build(np.arange(len(system)))
+
+    def __len__(self):
+
+        return len(self._lo)
+
+    def _build(self, surfaces):
+        """
+        Method adds a node for a group of surfaces, splitting the group
+        in half along the axis in which their boxes are most spread out
+
+        Parameters
+        ----------
+        surfaces: array of indices of the surfaces in the group
+
+        Returns
+        -------
+        index of the new node
+        """
+
+        node = len(self._lo)
+
+        self._lo.append(self._surf_lo[surfaces].min(axis=0))
+        self._hi.append(self._surf_hi[surfaces].max(axis=0))
+        self._children.append(None)
+        self._surfaces.append(surfaces)
+
+        if len(surfaces) <= self._leaf_size:
+            return node
+
+        # centres of the boxes, treating infinite planes as on axis
+        with np.errstate(invalid='ignore'):
+            centre = np.nan_to_num((self._surf_lo[surfaces] +
+                                    self._surf_hi[surfaces]) / 2,
+                                   nan=0, posinf=0, neginf=0)
+
+        axis = np.argmax(np.ptp(centre, axis=0))
+        order = surfaces[np.argsort(centre[:, axis], kind='stable')]
+        half = len(order) // 2
+
+        left = self._build(order[:half])
+        right = self._build(order[half:])
+
+        self._children[node] = (left, right)
+
+        return node
+
+    def candidates(self, p, k_hat, t_min=T_MIN):
+        """
+        Method finds the surfaces each ray could hit, by passing the rays
+        down the tree and only keeping them in the boxes they enter
+
+        Parameters
+        ----------
+        p: (N, 3) array of start points of the rays
+
+        k_hat: (N, 3) array of unit direction vectors of the rays
+
+        t_min: smallest distance along the rays counted as ahead of them
+
+        Returns
+        -------
+        list of (surface, rays) pairs, where rays is the array of
+        indices of the rays whose path enters the box of the surface
+        """
+
+        pairs = []
+        stack = [(0, np.arange(len(p)))]
+
+        while stack:
+            node, rays = stack.pop()
+
+            rays = rays[box_hit(p[rays], k_hat[rays], self._lo[node],
+                                self._hi[node], t_min)]
+
+            if len(rays) == 0:
+                continue
+
+            if self._children[node] is None:
+                for surface in self._surfaces[node]:
+                    pairs.append((surface, rays))
+            else:
+                stack.extend((child, rays)
+                             for child in self._children[node])
+
+        return pairs
+
+    def nearest_hit(self, p, k_hat, t_min=T_MIN):
+        """
+        Method finds the nearest surface ahead of each ray, passing the
+        rays down the tree nearest box first and skipping every box that
+        starts beyond the nearest intercept a ray has found so far
+
+        Parameters
+        ----------
+        p: (N, 3) array of start points of the rays
+
+        k_hat: (N, 3) array of unit direction vectors of the rays
+
+        t_min: smallest distance along the rays counted as ahead of them
+
+        Returns
+        -------
+        surface: array of the index of the surface each ray hits,
+                 -1 for rays that hit nothing
+
+        hit: Hit object for the intercept of each ray with its surface
+        """
+
+        nearest = _Nearest(self._system, p, k_hat, t_min,
+                           (self._surf_lo, self._surf_hi))
+
+        t_root = box_distance(p, k_hat, self._lo[0], self._hi[0], t_min)
+        rays = np.flatnonzero(t_root < np.inf)
+        stack = [(0, rays, t_root[rays])]
+
+        while stack:
+            node, rays, t_near = stack.pop()
+
+            # boxes entered beyond the nearest intercept cannot hold it
+            rays = rays[t_near <= nearest.distance[rays]]
+
+            if len(rays) == 0:
+                continue
+
+            if self._children[node] is None:
+                for surface in self._surfaces[node]:
+                    nearest.update(surface, rays)
+                continue
+
+            left, right = self._children[node]
+
+            t_left = box_distance(p[rays], k_hat[rays], self._lo[left],
+                                  self._hi[left], t_min)
+            t_right = box_distance(p[rays], k_hat[rays], self._lo[right],
+                                   self._hi[right], t_min)
+
+            # the far child of each ray is pushed first, so it is
+            # popped after the near child has shortened the distance
+            left_first = t_left <= t_right
+            stack.append((right, rays[left_first], t_right[left_first]))
+            stack.append((left, rays[~left_first], t_left[~left_first]))
+            stack.append((right, rays[~left_first], t_right[~left_first]))
+            stack.append((left, rays[left_first], t_left[left_first]))
+
+        return nearest.surface, nearest.hit()
+
+
+def all_candidates(system, n_rays):
+    """
+    Function that pairs every ray with every surface of a system,
+    the brute force alternative to SurfaceBVH.candidates
+
+    Parameters
+    ----------
+    system: OpticalSystem object
+
+    n_rays: number of rays
+
+    Returns
+    -------
+    list of (surface, rays) pairs
+    """
+
+    rays = np.arange(n_rays)
+
+    return [(surface, rays) for surface in range(len(system))]
+
+
+def nearest_hit(system, p, k_hat, candidates, t_min=T_MIN, bounds=None):
+    """
+    Function that finds the nearest valid intercept ahead of each ray
+    out of the candidate surfaces for that ray, only counting intercepts
+    on the cap of each surface within its bounding box, so the far side
+    of a sphere is never mistaken for the surface, and counting the rays
+    blocked by a stop as hitting it
+
+    Parameters
+    ----------
+    system: OpticalSystem object
+
+    p: (N, 3) array of start points of the rays
+
+    k_hat: (N, 3) array of unit direction vectors of the rays
+
+    candidates: list of (surface, rays) pairs, where rays is an array
+                of indices of the rays to test against the surface
+
+    t_min: smallest distance along the rays counted as ahead of them
+
+    bounds: (lo, hi) arrays of the box around each surface,
+            found by surface_bounds if None
+
+    Returns
+    -------
+    surface: array of the index of the surface each ray hits,
+             -1 for rays that hit nothing
+
+    hit: Hit object for the intercept of each ray with its surface,
+         with status VIGNETTED for rays blocked by a stop
+         and MISSED for rays that hit nothing
+    """
+
+    if bounds is None:
+        bounds = surface_bounds(system)
+
+    nearest = _Nearest(system, p, k_hat, t_min, bounds)
+
+    for i, rays in candidates:
+        nearest.update(i, rays)
+
+    return nearest.surface, nearest.hit()
+
+
+class _Nearest:
+    """
+    Class for the nearest intercept found so far for each of a set of rays,
+    updated with the intercepts of the rays with one surface at a time
+    """
+
+    def __init__(self, system, p, k_hat, t_min, bounds):
+        """
+        Parameters
+        ----------
+        system: OpticalSystem object
+
+        p: (N, 3) array of start points of the rays
+
+        k_hat: (N, 3) array of unit direction vectors of the rays
+
+        t_min: smallest distance along the rays counted as ahead of them
+
+        bounds: (lo, hi) arrays of the box around each surface
+        """
+
+        n_rays = len(p)
+
+        self._system = system
+        self._p = p
+        self._k_hat = k_hat
+        self._t_min = t_min
+        self._lo, self._hi = bounds
+
+        self.surface = np.full(n_rays, -1)
+        self.point = np.array(p, dtype=float)
+        self.normal = np.zeros((n_rays, 3))
+        self.distance = np.full(n_rays, np.inf)
+        self.status = np.full(n_rays, rt.MISSED, dtype=np.int8)
+
+    def update(self, i, rays):
+        """
+        Method keeps the intercepts of some of the rays with a surface
+        that are nearer than any found before, only counting intercepts on
+        the cap of the surface within its box, and counting the rays
+        blocked by a stop as hitting it
+
+        Parameters
+        ----------
+        i: index of the surface
+
+        rays: array of indices of the rays to test against the surface
+        """
+
+        system = self._system
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hit = system.hit(self._p[rays], self._k_hat[rays], i)
+
+            if system._kind[i] == osys.STOP:
+                nearer = hit.status != rt.MISSED
+            else:
+                nearer = hit.valid
+
+            nearer &= hit.distance > self._t_min
+            nearer &= hit.distance < self.distance[rays]
+            nearer &= np.all((hit.point >= self._lo[i]) &
+                             (hit.point <= self._hi[i]), axis=-1)
+
+        rays = rays[nearer]
+        self.surface[rays] = i
+        self.point[rays] = hit.point[nearer]
+        self.normal[rays] = hit.normal[nearer]
+        self.distance[rays] = hit.distance[nearer]
+        self.status[rays] = hit.status[nearer]
+
+    def hit(self):
+        """
+        Method returns the nearest intercepts found
+
+        Returns
+        -------
+        Hit object for the intercept of each ray with its surface,
+        with status VIGNETTED for rays blocked by a stop
+        and MISSED for rays that hit nothing
+        """
+
+        return oe.Hit(self.point, self.normal, self.distance, self.status)
@@ -0,0 +1,357 @@
+"""
+design_sweep.py
+agent, 18/10/26
+Module to explore lens designs with grid sweeps and multi-start optimisation
+over a pool of worker processes, with checkpoints so long sweeps can resume
+"""
+
+import heapq
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import scipy.optimize as sp
+import optical_system as osys
+import rms_objective as ro
+
+# objective shared by every task run in a worker process
+_objective = None
+
+
+def _init_worker(objective):
+    """
+    Function run once in each worker process to keep its own copy
+    of the objective, with the prebuilt rays, for every task
+
+    Parameters
+    ----------
+    objective: RmsObjective object
+    """
+
+    global _objective
+    _objective = objective
+
+
+def _grid_task(designs):
+    """
+    Function that finds the RMS spot radius for a chunk of grid points
+
+    Parameters
+    ----------
+    designs: (D, n_params) array of the designs in the chunk
+
+    Returns
+    -------
+    array of the RMS spot radius of each design
+    """
+
+    return _objective.evaluate(designs)
+
+
+def _start_task(x0, bounds):
+    """
+    Function that optimises a design from a single starting point
+
+    Parameters
+    ----------
+    x0: array of parameters to start from
+
+    bounds: list of (min, max) bounds for each parameter
+
+    Returns
+    -------
+    rms: RMS spot radius of the optimised design
+
+    x: array of parameters of the optimised design
+    """
+
+    x, nfeval, rc = sp.fmin_tnc(_objective.value_and_grad, x0,
+                                bounds=bounds, disp=0)
+
+    return _objective(x), x
+
+
+class DesignSweep:
+    """
+    Class for a sweep over the parameters of an optical system,
+    keeping a leaderboard of the designs with the smallest RMS spot radius
+    """
+
+    def __init__(self, elems, bundle, bounds, params=('curv',), workers=None,
+                 checkpoint=None, n_best=10):
+        """
+        Parameters
+        ----------
+        elems: list of SphericalRefraction and OutputPlane objects,
+               or an OpticalSystem object
+
+        bundle: Bundle object for the beam of rays traced for every design
+
+        bounds: list of (min, max) bounds for each parameter, in the order
+                given by RmsObjective for the same params
+
+        params: names of the parameters varied for every refracting surface
+
+        workers: number of worker processes, by default every task is run
+                 in this process
+
+        checkpoint: path of a file the progress is saved to after every
+                    task, and resumed from if it already exists
+
+        n_best: number of designs kept on the leaderboard
+        """
+
+        if not isinstance(elems, osys.OpticalSystem):
+            elems = osys.OpticalSystem(elems)
+
+        # the rays are built once here and copied to each worker
+        self._objective = ro.RmsObjective(elems, bundle, params)
+
+        if len(bounds) != self._objective.n_params():
+            raise Exception('Expected bounds for %d parameters'
+                            % self._objective.n_params())
+
+        self._bounds = [(float(lo), float(hi)) for lo, hi in bounds]
+        self._params = list(params)
+        self._fingerprints = {'system': elems.fingerprint(),
+                              'bundle': bundle.fingerprint()}
+        self._workers = workers
+        self._checkpoint = checkpoint
+        self._n_best = n_best
+
+        self._leaderboard = []  # heap of (-rms, x) for the best designs
+
+    def leaderboard(self):
+        """
+        Method returns the best designs found so far
+
+        Returns
+        -------
+        list of (rms, x) for the best designs, smallest RMS first
+        """
+
+        return [(-neg_rms, np.array(x))
+                for neg_rms, x in sorted(self._leaderboard, reverse=True)]
+
+    def best(self):
+        """
+        Method returns the best design found so far
+
+        Returns
+        -------
+        rms: RMS spot radius of the best design
+
+        x: array of parameters of the best design
+        """
+
+        return self.leaderboard()[0]
+
+    def _record(self, rms, x):
+        """
+        Method adds a design to the leaderboard if it is one of the best
+
+        Parameters
+        ----------
+        rms: RMS spot radius of the design
+
+        x: array of parameters of the design
+        """
+
+        if not np.isfinite(rms):  # every ray was stopped
+            return
+
+        entry = (-float(rms), [float(v) for v in x])
+
+        # a design evaluated again, or resumed from a checkpoint
+        if any(entry[1] == old for neg_rms, old in self._leaderboard):
+            return
+
+        if len(self._leaderboard) < self._n_best:
+            heapq.heappush(self._leaderboard, entry)
+        else:
+            heapq.heappushpop(self._leaderboard, entry)
+
+    def grid(self, n_points, chunk_size=256):
+        """
+        Method evaluates every design on a regular grid over the bounds
+
+        Parameters
+        ----------
+        n_points: number of grid points along each parameter
+
+        chunk_size: number of designs traced together in each task
+
+        Returns
+        -------
+        list of (rms, x) for the best designs, smallest RMS first
+        """
+
+        axes = [np.linspace(lo, hi, n_points) for lo, hi in self._bounds]
+        designs = np.stack(np.meshgrid(*axes, indexing='ij'),
+                           axis=-1).reshape(-1, len(axes))
+
+        tasks = [(designs[i:i + chunk_size],)
+                 for i in range(0, len(designs), chunk_size)]
+
+        def record(task, rms):
+            for r, x in zip(rms, task[0]):
+                self._record(r, x)
+
+        self._run(self._sweep('grid', n_points=n_points,
+                              chunk_size=chunk_size),
+                  _grid_task, tasks, record)
+
+        return self.leaderboard()
+
+    def multistart(self, n_starts, seed=0):
+        """
+        Method optimises designs from random starting points within the
+        bounds, using the analytic gradient of the RMS spot radius
+
+        Parameters
+        ----------
+        n_starts: number of starting points
+
+        seed: seed of the random number generator for the starting points
+
+        Returns
+        -------
+        list of (rms, x) for the best designs, smallest RMS first
+        """
+
+        lo, hi = np.array(self._bounds).T
+        starts = np.random.default_rng(seed).uniform(
+            lo, hi, (n_starts, len(lo)))
+
+        tasks = [(x0, self._bounds) for x0 in starts]
+
+        def record(task, result):
+            self._record(*result)
+
+        self._run(self._sweep('multistart', n_starts=n_starts, seed=seed),
+                  _start_task, tasks, record)
+
+        return self.leaderboard()
+
+    def _sweep(self, kind, **settings):
+        """
+        Method describes a sweep, with everything that decides its tasks
+        and their results, so a checkpoint is only resumed by the same sweep
+
+        Parameters
+        ----------
+        kind: type of sweep, 'grid' or 'multistart'
+
+        settings: arguments of the sweep deciding how its tasks are made
+
+        Returns
+        -------
+        dictionary describing the sweep, as saved in the checkpoint
+        """
+
+        sweep = dict(settings, kind=kind, bounds=self._bounds,
+                     params=self._params, **self._fingerprints)
+
+        # as it would be read back from the checkpoint file
+        return json.loads(json.dumps(sweep))
+
+    def _run(self, name, func, tasks, record):
+        """
+        Method runs tasks in this process or in a pool of workers,
+        skipping tasks finished before a checkpoint and saving a new
+        checkpoint after every task
+
+        Parameters
+        ----------
+        name: dictionary describing the sweep, saved with the checkpoint
+
+        func: function run for each task
+
+        tasks: list of tuples of arguments for each task
+
+        record: function given each task and its result
+        """
+
+        done = self._load(name)
+        todo = [i for i in range(len(tasks)) if i not in done]
+
+        if not self._workers:
+            _init_worker(self._objective)
+
+            for i in todo:
+                record(tasks[i], func(*tasks[i]))
+                done.add(i)
+                self._save(name, done)
+
+            return
+
+        with ProcessPoolExecutor(max_workers=self._workers,
+                                 initializer=_init_worker,
+                                 initargs=(self._objective,)) as pool:
+            futures = {pool.submit(func, *tasks[i]): i for i in todo}
+
+            for future in as_completed(futures):
+                i = futures[future]
+                record(tasks[i], future.result())
+                done.add(i)
+                self._save(name, done)
+
+    def _load(self, name):
+        """
+        Method resumes a sweep from its checkpoint file, if there is one
+
+        Parameters
+        ----------
+        name: dictionary describing the sweep, which must match the
+              one saved in the checkpoint
+
+        Returns
+        -------
+        set of the tasks already finished
+        """
+
+        if self._checkpoint is None or not os.path.exists(self._checkpoint):
+            return set()
+
+        with open(self._checkpoint) as f:
+            state = json.load(f)
+
+        saved = state['sweep']
+
+        changed = sorted(key for key in set(name) | set(saved)
+                         if name.get(key) != saved.get(key))
+
+        if changed:
+            raise Exception('Checkpoint %s is for a different sweep, with'
+                            ' different %s' % (self._checkpoint,
+                                               ', '.join(changed)))
+
+        for rms, x in state['leaderboard']:
+            self._record(rms, x)
+
+        return set(state['done'])
+
+    def _save(self, name, done):
+        """
+        Method saves the progress of a sweep to its checkpoint file
+
+        Parameters
+        ----------
+        name: dictionary describing the sweep
+
+        done: set of the tasks finished
+        """
+
+        if self._checkpoint is None:
+            return
+
+        state = {'sweep': name, 'done': sorted(done),
+                 'leaderboard': [(rms, x.tolist())
+                                 for rms, x in self.leaderboard()]}
+
+        # writing to a new file first so an interruption cannot corrupt it
+        with open(self._checkpoint + '.tmp', 'w') as f:
+            json.dump(state, f)
+
+        os.replace(self._checkpoint + '.tmp', self._checkpoint)
@@ -0,0 +1,292 @@
+"""
+focus.py
+agent, 18/10/26
+Module to find the RMS spot radius of traced rays at any output plane
+position from their final segments, and the position of best focus
+"""
+
+import numpy as np
+import raytracer as rt
+import optical_system as osys
+
+
+def final_segments(rays):
+    """
+    Function that gathers the current points and directions of the rays
+    that are still propagating, skipping any that were stopped
+
+    Parameters
+    ----------
+    rays: list of ray objects, or a RayBatch object
+
+    Returns
+    -------
+    p: (M, 3) array of the current point of each surviving ray
+
+    k: (M, 3) array of the current direction of each surviving ray
+    """
+
+    if isinstance(rays, rt.RayBatch):
+        alive = rays.alive()
+        return rays.p()[alive], rays.k()[alive]
+
+    alive = [ray for ray in rays if ray.alive()]
+
+    p = np.array([ray.p() for ray in alive], dtype=float).reshape(-1, 3)
+    k = np.array([ray.k() for ray in alive], dtype=float).reshape(-1, 3)
+
+    return p, k
+
+
+def _spot_moments(p, k, valid):
+    """
+    Function that sums the moments of the final segments of rays that
+    give the mean squared spot radius on a plane at any z, which is a
+    quadratic in z since each point in the spot moves linearly with z
+
+    Parameters
+    ----------
+    p: (..., N, 3) array of the final point of each ray
+
+    k: (..., N, 3) array of the final direction of each ray
+
+    valid: (..., N) boolean array of the rays making up each spot,
+           rays not heading towards a plane ahead are also left out
+
+    Returns
+    -------
+    z_ref: (...) array of the reference z of each spot, near its points
+           so the moments do not lose precision
+
+    count: (...) array of the number of rays making up each spot
+
+    moments: dictionary of (m_xx, m_xs, m_ss) for radii measured about
+             the optical axis (False) and about the centroid (True),
+             so the mean squared radius at z is
+             m_xx + 2*m_xs*(z - z_ref) + m_ss*(z - z_ref)**2
+    """
+
+    valid = valid & (k[..., 2] > 0)
+    count = np.sum(valid, axis=-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = valid / count[..., np.newaxis]  # 1/count for each ray
+
+        z_ref = np.sum(np.where(valid, weight * p[..., 2], 0), axis=-1)
+
+        slope = k[..., :2] / k[..., 2:]  # change in x and y along z
+        xy = p[..., :2] + slope * (z_ref[..., np.newaxis, np.newaxis] -
+                                   p[..., 2:])
+
+    weight = weight[..., np.newaxis]
+    slope = np.where(valid[..., np.newaxis], slope, 0)
+    xy = np.where(valid[..., np.newaxis], xy, 0)
+
+    moments = {}
+
+    for centroid in (False, True):
+        if centroid:
+            xy = np.where(valid[..., np.newaxis],
+                          xy - np.sum(weight * xy, axis=-2, keepdims=True), 0)
+            slope = np.where(valid[..., np.newaxis],
+                             slope - np.sum(weight * slope, axis=-2,
+                                            keepdims=True), 0)
+
+        moments[centroid] = tuple(np.sum(weight * m, axis=(-2, -1))
+                                  for m in (xy**2, xy*slope, slope**2))
+
+    return z_ref, count, moments
+
+
+class FocusSearch:
+    """
+    Class for the spot made by traced rays on an output plane at any z,
+    extrapolating the final straight segment of every ray, so moving the
+    plane does not need the rays to be traced through the lens again
+    """
+
+    def __init__(self, rays):
+        """
+        Parameters
+        ----------
+        rays: RayBatch object, or list of ray objects, traced through the
+              refracting surfaces (and, optionally, an output plane)
+        """
+
+        p, k = final_segments(rays)
+
+        self._z_ref, self._count, self._moments = _spot_moments(
+            p, k, np.ones(len(p), dtype=bool))
+
+        if self._count == 0:
+            raise Exception('No rays are propagating towards an output plane')
+
+    def count(self):
+        """
+        Method returns the number of rays making up the spot
+
+        Returns
+        -------
+        number of surviving rays heading towards the output plane
+        """
+
+        return self._count
+
+    def rms(self, z, centroid=False):
+        """
+        Method finds the RMS spot radius on output planes at any z
+
+        Parameters
+        ----------
+        z: z-coordinate of the output plane, or array of z-coordinates
+
+        centroid: if True, the radius is measured from the centroid
+                  of the spot rather than the optical axis
+
+        Returns
+        -------
+        RMS spot radius at each z
+        """
+
+        m_xx, m_xs, m_ss = self._moments[centroid]
+        dz = np.asarray(z, dtype=float) - self._z_ref
+
+        return np.sqrt(np.maximum(m_xx + 2*m_xs*dz + m_ss*dz**2, 0))
+
+    def best_focus(self, centroid=False):
+        """
+        Method finds the output plane position with the smallest RMS
+        spot radius, the minimum of the quadratic found in closed form
+
+        Parameters
+        ----------
+        centroid: if True, the radius is measured from the centroid
+                  of the spot rather than the optical axis
+
+        Returns
+        -------
+        z: z-coordinate of the plane of best focus
+
+        rms: RMS spot radius at the plane of best focus
+        """
+
+        m_xx, m_xs, m_ss = self._moments[centroid]
+
+        if m_ss == 0:
+            raise Exception('Rays are parallel, so there is no best focus')
+
+        z = self._z_ref - m_xs/m_ss
+
+        return z, self.rms(z, centroid)
+
+
+def best_focus(elems, rays, centroid=False):
+    """
+    Function that traces rays through an optical system once and finds
+    the output plane position with the smallest RMS spot radius
+
+    Parameters
+    ----------
+    elems: OpticalSystem object, or list of optical elements
+
+    rays: RayBatch object, or list of ray objects, which are propagated
+
+    centroid: if True, the radius is measured from the centroid
+              of the spot rather than the optical axis
+
+    Returns
+    -------
+    z: z-coordinate of the plane of best focus
+
+    rms: RMS spot radius at the plane of best focus
+    """
+
+    if not isinstance(elems, osys.OpticalSystem):
+        elems = osys.OpticalSystem(elems)
+
+    elems.trace(rays)
+
+    return FocusSearch(rays).best_focus(centroid)
+
+
+def tilt(direction, angles):
+    """
+    Function that tilts a direction by field angles in the x-z plane,
+    rotating it about the y-axis
+
+    Parameters
+    ----------
+    direction: 1D numpy array for the direction of the rays on axis
+
+    angles: array of field angles, in radians
+
+    Returns
+    -------
+    (A, 3) array of the tilted direction for each angle
+    """
+
+    direction = np.asarray(direction, dtype=float)
+    angles = np.atleast_1d(np.asarray(angles, dtype=float))
+
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+
+    return np.stack((cos*direction[0] + sin*direction[2],
+                     np.full(len(angles), direction[1]),
+                     -sin*direction[0] + cos*direction[2]), axis=-1)
+
+
+def field_sweep(elems, bundle, angles, z, centroid=True, workers=None):
+    """
+    Function that finds the RMS spot radius of a beam for every
+    combination of field angle and output plane position, tracing the
+    beams for all the angles together as one batch of rays, then moving
+    the output plane along the final segments of the rays
+
+    Parameters
+    ----------
+    elems: OpticalSystem object, or list of optical elements
+
+    bundle: Bundle object for the beam of rays, whose initial direction
+            is tilted by each field angle
+
+    angles: array of field angles, in radians
+
+    z: array of z-coordinates of the output plane
+
+    centroid: if True, the radius is measured from the centroid of each
+              spot, which moves off the optical axis for tilted beams
+
+    workers: number of processes to split the batch between,
+             by default it is traced in this process
+
+    Returns
+    -------
+    (A, Z) array of the RMS spot radius for each angle and z,
+    which is nan for an angle where every ray was stopped
+    """
+
+    if not isinstance(elems, osys.OpticalSystem):
+        elems = osys.OpticalSystem(elems)
+
+    beam = bundle.create_batch(history=False)
+
+    directions = tilt(beam.k()[0], angles)
+    n_angles = len(directions)
+    n_rays = len(beam)
+
+    # the beam for each angle is stacked into a single (A*N) batch
+    batch = rt.RayBatch(np.tile(beam.p(), (n_angles, 1)),
+                        np.repeat(directions, n_rays, axis=0), history=False)
+
+    elems.trace(batch, workers)
+
+    z_ref, count, moments = _spot_moments(
+        batch.p().reshape(n_angles, n_rays, 3),
+        batch.k().reshape(n_angles, n_rays, 3),
+        batch.alive().reshape(n_angles, n_rays))
+
+    m_xx, m_xs, m_ss = (m[:, np.newaxis] for m in moments[centroid])
+    dz = np.asarray(z, dtype=float)[np.newaxis, :] - z_ref[:, np.newaxis]
+
+    return np.sqrt(np.maximum(m_xx + 2*m_xs*dz + m_ss*dz**2, 0))
@@ -9,52 +9,50 @@ import numpy as np
 import scipy.optimize as sp
 import raytracer as rt
 import optical_elements as oe
+import optical_system as osys
+import rms_objective as ro
 import plot as pt
 
+# lens config. where convex surface faces the input,
+# the curvatures are swapped in by the objective for each design
+conv_surf1 = oe.SphericalRefraction(
+    z0=[0, 0, 100], curv=0.02, n1=1, n2=1.5168, ap_rad=100)
+conv_surf2 = oe.SphericalRefraction(
+    z0=[0, 0, 105], curv=-0.02, n1=1.5168, n2=1, ap_rad=100)
 
-def optimize_rms(curvs):
-
-    # lens config. where convex surface faces the input
-    conv_surf1 = oe.SphericalRefraction(
-        z0=[0, 0, 100], curv=curvs[0], n1=1, n2=1.5168, ap_rad=100)
-    conv_surf2 = oe.SphericalRefraction(
-        z0=[0, 0, 105], curv=curvs[1], n1=1.5168, n2=1, ap_rad=100)
-
-    # at paraxial focus of plano convex lens, where convex surface faces input
-    output_plane = oe.OutputPlane(z=198.45)
-
-    elems = [conv_surf1, conv_surf2, output_plane]
-
-    # for a beam with diameter 10mm
-    radius = [5]
+# at paraxial focus of plano convex lens, where convex surface faces input
+output_plane = oe.OutputPlane(z=198.45)
 
-    for i in range(len(radius)):
-        bundle = rt.Bundle((np.linspace(0, radius[i], 6)), [
-            1, 10, 20, 30, 40, 50], 0, [0, 0, 1])
+elems = [conv_surf1, conv_surf2, output_plane]
 
-        bundle.positions()
+# for a beam with diameter 10mm
+bundle = rt.Bundle((np.linspace(0, 5, 6)), [
+    1, 10, 20, 30, 40, 50], 0, [0, 0, 1])
 
-        rays = bundle.create_rays()
+# the rays are only built once and traced for every design
+objective = ro.RmsObjective(osys.OpticalSystem(elems), bundle)
 
-        for elem in elems:
-            elem.propagate_rays(rays)
 
-        rms = pt.rms(rays)
-
-        # plots spot diagram
-        # for each implementation of the minimisation algorithm
-
-        pt.spot_pf(rays)  # comment out to run code quickly
+def optimize_rms(curvs):
 
-    return rms
+    return objective(curvs)
 
 
 # x0 array from plano convex lens curvatures, 0.02 and -0.02
+# the gradient is traced along with the rays (forward-mode differentiation)
 
-x, nfeval, rc = sp.fmin_tnc(optimize_rms, np.array([0.02, -0.02]), bounds=[
-    (-0.05, 0.05), (-0.05, 0.05)], approx_grad=True)
+x, nfeval, rc = sp.fmin_tnc(objective.value_and_grad, np.array([0.02, -0.02]),
+                            bounds=[(-0.05, 0.05), (-0.05, 0.05)])
 
 print('Curvature 1:', x[0], '\nCurvature 2:', x[1])
 
 optim_rms = optimize_rms(x)
 print('\nOptimised RMS:', optim_rms)
+
+# plots spot diagram for the optimised lens
+conv_surf1._curv = x[0]
+conv_surf2._curv = x[1]
+
+rays = bundle.create_batch()
+osys.OpticalSystem(elems).trace(rays)
+pt.spot_pf(rays)
@@ -0,0 +1,148 @@
+"""
+nonsequential.py
+agent, 18/10/26
+Module to trace batches of rays non-sequentially, where each ray goes on
+to whichever surface it meets first rather than the next in the list,
+so rays can be reflected back, skip surfaces or follow folded paths
+"""
+
+import numpy as np
+import raytracer as rt
+import optical_elements as oe
+import optical_system as osys
+import bvh
+
+
+def trace_nonsequential(elems, batch, max_bounces=100, accelerate=True):
+    """
+    Function that traces a batch of rays non-sequentially, repeatedly
+    moving each ray to the nearest surface ahead of it until it reaches
+    an output plane, hits nothing or runs out of bounces
+
+    At a refracting surface the refractive indices are taken in the order
+    the ray crosses it, n1 to n2 when it travels along the surface normal
+    and n2 to n1 when it travels back, and rays undergoing total internal
+    reflection are reflected rather than stopped. Apertures only limit
+    the extent of each surface, so rays outside them pass it by, while
+    stops block the rays outside their apertures.
+
+    Parameters
+    ----------
+    elems: OpticalSystem object, or list of optical elements in any order
+
+    batch: object of the RayBatch class, updated in place
+
+    max_bounces: largest number of surfaces a ray can meet, rays still
+                 bouncing after that are stopped with status TRUNCATED
+
+    accelerate: if True, the nearest surfaces are found through a
+                SurfaceBVH, otherwise every ray is tested against every
+                surface
+
+    Returns
+    -------
+    batch: the propagated batch of rays, with each ray's last point
+           on an output plane if it reached one
+
+    order: (N, B) array of the surfaces each ray met in turn, padded
+           with -1 once it stopped bouncing, where B is the largest
+           number of bounces made by any ray
+    """
+
+    if not isinstance(elems, osys.OpticalSystem):
+        elems = osys.OpticalSystem(elems)
+
+    if accelerate:
+        tree = bvh.SurfaceBVH(elems)
+    else:
+        bounds = bvh.surface_bounds(elems)
+
+    n_rays = len(batch)
+
+    # the smallest integers holding every surface index and -1,
+    # with columns added as the rays make more bounces
+    dtype = np.min_scalar_type(-max(len(elems), 1))
+    order = np.full((n_rays, min(max_bounces, 8)), -1, dtype=dtype)
+
+    # rays still bouncing, packed densely and compacted as they stop,
+    # with the rows they came from in the batch
+    rows = np.flatnonzero(batch.alive())
+    work = batch.compact()
+
+    finished = []  # (rows, rays) for the rays that stopped bouncing
+    n_bounces = 0
+    scratch = oe.SnellScratch()  # reused at every bounce
+
+    for bounce in range(max_bounces):
+
+        if len(rows) == 0:
+            break
+
+        p = work.p()
+        k = oe.normalise(work.k())
+
+        if accelerate:
+            surface, hit = tree.nearest_hit(p, k)
+        else:
+            surface, hit = bvh.nearest_hit(
+                elems, p, k, bvh.all_candidates(elems, len(rows)),
+                bounds=bounds)
+
+        missed = surface < 0
+        blocked = hit.status == rt.VIGNETTED  # by a stop
+        kind = elems._kind[np.where(missed, 0, surface)]
+        refracting = ~missed & (kind == osys.REFRACTING)
+
+        if bounce == order.shape[1]:
+            order = np.concatenate((order, np.full_like(order, -1)), axis=1)
+
+        order[rows, bounce] = surface
+        n_bounces = bounce + 1
+
+        new_p = np.where(missed[:, np.newaxis], p, hit.point)
+        new_n = np.array(work._n)
+
+        if np.any(refracting):
+            i = surface[refracting]
+            normal = hit.normal[refracting]
+
+            # the surface normal faces from the n1 side to the n2 side
+            forward = oe._dot(k[refracting], normal) > 0
+            n_in = np.where(forward, elems._n1[i], elems._n2[i])
+            n_out = np.where(forward, elems._n2[i], elems._n1[i])
+
+            k[refracting], tir = oe.snell_batch(k[refracting], normal,
+                                                n_in/n_out, scratch=scratch)
+            new_n[refracting] = np.where(tir, n_in, n_out)
+
+        work.append(new_p, k, n=new_n)
+        work.terminate(missed, rt.MISSED)
+        work.terminate(blocked, rt.VIGNETTED)
+
+        if batch._history is not None:
+            elems._scatter(batch, work, rows, vertex=True)
+
+        # rays reaching an output plane finish there, still ALIVE
+        bouncing = ~missed & ~blocked & (kind != osys.OUTPUT)
+
+        if not np.all(bouncing):
+            finished.append((rows[~bouncing], work.compact(~bouncing)))
+            rows = rows[bouncing]
+            work = work.compact(bouncing)
+
+    work.terminate(np.ones(len(work), dtype=bool), rt.TRUNCATED)
+    finished.append((rows, work))
+
+    # writing every ray back into the batch at once
+    rows = np.concatenate([done[0] for done in finished])
+    work = rt.RayBatch(np.concatenate([done[1].p() for done in finished]),
+                       np.concatenate([done[1].k() for done in finished]),
+                       history=False)
+    work._status[:] = np.concatenate([done[1].status()
+                                      for done in finished])
+    work._opl[:] = np.concatenate([done[1].opl() for done in finished])
+    work._n[:] = np.concatenate([done[1]._n for done in finished])
+
+    elems._scatter(batch, work, rows)
+
+    return batch, order[:, :n_bounces]
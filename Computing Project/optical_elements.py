@@ -3,30 +3,115 @@ optical_elements.py
 Emily Chini, 28/10/22
 Module to describe optical elements, such as refracting surfaces and lenses
 """
+import math
+
 import numpy as np
+import raytracer as rt
+import profiling as pf
+import sharded_trace as st
 
 # %%
 # functions to be used in the class methods
 
 
-def normalise(v):
+def _dot(a, b, out=None):
+    """
+    A function that takes the dot product along the last axis,
+    for single 3D vectors or (N, 3) arrays of vectors
+
+    Parameters
+    ----------
+    a, b : arrays of 3D vectors
+
+    out : optional array to write the dot products of arrays of vectors
+          into
+
+    Returns
+    -------
+    the dot product of each pair of vectors
+    """
+
+    if np.ndim(a) == 1 and np.ndim(b) == 1:
+        return np.dot(a, b)  # cheaper than einsum for a single ray
+
+    return np.einsum('...i,...i->...', a, b, out=out)
+
+
+def normalise(v, out=None):
     """
-    A function that normalises any 3D vector
+    A function that normalises any 3D vector, or every row
+    of an (N, 3) array of 3D vectors
 
     Parameters
     ----------
-    v : 1D numpy array that represents a 3D vector
+    v : 1D numpy array that represents a 3D vector,
+        or (N, 3) numpy array of 3D vectors
+
+    out : optional float array to write the normalised vectors into,
+          which may be v itself to normalise in place, saving the
+          allocation of the result but not of the lengths of the vectors
 
     Returns
     -------
-    the corresponding normalised vector
+    the corresponding normalised vector(s)
     """
 
-    if len(v) != 3:
+    if out is not None and not np.issubdtype(out.dtype, np.floating):
+        raise Exception('out must be a float array to hold unit vectors')
+
+    v = np.asarray(v, dtype=float)
+
+    if np.shape(v)[-1] != 3:
         print('Incorrect dimension')
         return None
     else:
-        return v/np.sqrt(np.dot(v, v))
+        return np.divide(v, np.sqrt(_dot(v, v))[..., np.newaxis], out=out)
+
+
+def _snell_single(k1, n, n1, n2):
+    """
+    A function that applies Snell's law to a single ray,
+    without reporting total internal reflection
+
+    Parameters
+    ----------
+    k1: direction vector of the incident ray
+
+    n: direction vector of surface normal
+
+    n1: the refractive index one side of the surface
+
+    n2: the refractive index for the other side of the surface
+
+    Returns
+    -------
+    k2_hat: the refracted ray direction as a unit vector,
+            None if total internal reflection occurs
+    """
+
+    k1_hat = normalise(k1)  # unit vector for incident direction
+    n_hat = normalise(n)  # unit vector for surface normal
+
+    cos_1 = np.dot(k1_hat, n_hat)
+
+    if cos_1 < 0:  # facing the normal along the incident direction
+        n_hat = -n_hat
+        cos_1 = -cos_1
+
+    mu = n1/n2
+    cos_2_sq = 1 - ((mu**2)*(1 - (cos_1**2)))
+
+    if cos_2_sq < 0:
+        return None
+
+    # using equation for Snell's law in 3D
+
+    a = np.sqrt(cos_2_sq) * n_hat
+    b = mu * (k1_hat - (cos_1*n_hat))
+
+    k2_hat = a + b
+
+    return k2_hat
 
 
 def snell(k1, n, n1, n2):
@@ -46,33 +131,513 @@ def snell(k1, n, n1, n2):
 
     Returns
     -------
-    k2_hat: the refracted ray direction as a unit vector
+    k2_hat: the refracted ray direction as a unit vector,
+            None if total internal reflection occurs
     """
 
-    k1_hat = normalise(k1)  # unit vector for incident direction
-    n_hat = normalise(n)  # unit vector for surface normal
+    if np.ndim(k1) != 1 or np.ndim(n) != 1:
+        raise Exception('snell takes single vectors, '
+                        'use snell_batch for arrays of them')
 
-    theta_1 = np.arccos(np.fabs(np.dot(n_hat, k1_hat)))
+    k2_hat = _snell_single(k1, n, n1, n2)
 
-    if np.sin(theta_1) > n2/n1:
+    if k2_hat is None:
         print('\nTotal Internal Reflection occurs')
-        return None
 
+    return k2_hat
+
+
+class SnellScratch:
+
+    """
+    Class for the arrays snell_batch works in, which are only reallocated
+    when a larger batch comes along, so that refracting a batch at one
+    surface after another only allocates the refracted directions
+    """
+
+    def __init__(self):
+
+        self._size = 0
+        self._allocate(0)
+
+    def _allocate(self, size):
+        """
+        Method allocates the arrays for up to size rays
+
+        Parameters
+        ----------
+        size: number of rays
+        """
+
+        self._size = size
+        self._n_hat = np.empty((size, 3))  # unit normals
+        self._cos_1 = np.empty(size)
+        self._cos_2 = np.empty(size)
+        self._mu = np.empty(size)  # ratio of the refractive indices
+        self._coeff = np.empty(size)
+        self._tir = np.empty(size, dtype=bool)
+
+    def arrays(self, shape):
+        """
+        Method returns views of the arrays for rays of a given shape
+
+        Parameters
+        ----------
+        shape: shape of the arrays of rays, without the last axis of
+               their 3D vectors
+
+        Returns
+        -------
+        n_hat: array of the given shape with an axis of 3D vectors
+
+        cos_1, cos_2, mu, coeff: float arrays of the given shape
+
+        tir: boolean array of the given shape
+        """
+
+        size = int(np.prod(shape))
+
+        if size > self._size:
+            self._allocate(size)
+
+        return (self._n_hat[:size].reshape(shape + (3,)),
+                self._cos_1[:size].reshape(shape),
+                self._cos_2[:size].reshape(shape),
+                self._mu[:size].reshape(shape),
+                self._coeff[:size].reshape(shape),
+                self._tir[:size].reshape(shape))
+
+
+def snell_batch(k1, n, mu, out=None, scratch=None):
+    """
+    A function that uses Snell's law of refraction to determine the
+    directions of every row of (..., 3) arrays of refracted rays at once,
+    reflecting the rays that undergo total internal reflection
+
+    Parameters
+    ----------
+    k1: (..., 3) array of direction vectors of the incident rays
+
+    n: (..., 3) array of direction vectors of the surface normals
+
+    mu: the ratio n1/n2 of the refractive indices either side of the
+        surface, a scalar or an array that broadcasts against the rays
+
+    out: optional (..., 3) float array to write the refracted directions
+         into, which may be k1 itself to refract in place
+
+    scratch: optional SnellScratch object to work in, which together
+             with out means no arrays the size of the batch are allocated
+
+    Returns
+    -------
+    k2_hat: (..., 3) array of the refracted ray directions as unit vectors
+
+    tir: boolean mask of the rays undergoing total internal reflection,
+         for which k2_hat holds the reflected direction instead,
+         a view into scratch that the next call using it overwrites
+    """
+
+    k1 = np.asarray(k1, dtype=float)
+
+    if scratch is None:
+        scratch = SnellScratch()
+
+    n_hat, cos_1, cos_2, mu_tir, coeff, tir = scratch.arrays(k1.shape[:-1])
+
+    # unit vectors for the surface normals and incident directions
+    np.sqrt(_dot(n, n, out=cos_1), out=cos_1)
+    np.divide(n, cos_1[..., np.newaxis], out=n_hat)
+
+    np.sqrt(_dot(k1, k1, out=cos_1), out=cos_1)
+    k1_hat = np.divide(k1, cos_1[..., np.newaxis], out=out)
+
+    # facing the normals along the incident directions
+    _dot(k1_hat, n_hat, out=cos_1)
+    np.less(cos_1, 0, out=tir)
+    np.negative(n_hat, out=n_hat, where=tir[..., np.newaxis])
+    np.fabs(cos_1, out=cos_1)
+
+    # cos_2_sq = 1 - (mu**2)*(1 - cos_1**2)
+    np.copyto(mu_tir, mu)
+    np.multiply(cos_1, cos_1, out=cos_2)
+    np.subtract(1, cos_2, out=cos_2)
+    np.multiply(mu_tir, mu_tir, out=coeff)
+    np.multiply(coeff, cos_2, out=cos_2)
+    np.subtract(1, cos_2, out=cos_2)
+
+    np.less(cos_2, 0, out=tir)
+
+    # using equation for Snell's law in 3D, written as
+    # k2_hat = mu*k1_hat + (cos_2 - mu*cos_1)*n_hat,
+    # or the law of reflection k1_hat - 2*cos_1*n_hat for TIR
+    np.maximum(cos_2, 0, out=cos_2)
+    np.sqrt(cos_2, out=cos_2)
+    np.copyto(mu_tir, 1, where=tir)
+
+    np.multiply(mu_tir, cos_1, out=coeff)
+    np.subtract(cos_2, coeff, out=coeff)
+    np.subtract(coeff, cos_1, out=coeff, where=tir)
+
+    k1_hat *= mu_tir[..., np.newaxis]
+    n_hat *= coeff[..., np.newaxis]
+    k1_hat += n_hat
+
+    return k1_hat, tir
+
+
+# %%
+# geometry shared by the optical elements and compiled optical systems
+
+
+def sphere_hit(p, k_hat, z0, curv, ap_rad_sq):
+    """
+    A function that finds the first valid intercept of a ray,
+    or of every row of an (N, 3) array of rays, with a spherical surface
+    together with the surface normal there
+
+    The surface constants may also be arrays that broadcast against the
+    rays, for example with shape (D, 1) to trace D designs of the surface
+    through (D, N, 3) arrays of rays at once
+
+    Parameters
+    ----------
+    p: start point of the ray, or (..., 3) array of them
+
+    k_hat: unit direction vector of the ray, or (..., 3) array of them
+
+    z0: 3D vector for the intercept of the surface with the z-axis
+
+    curv: the curvature of the surface defined by 1/radius of curvature
+
+    ap_rad_sq: the square of the maximum extent of the surface from its
+               axis
+
+    Returns
+    -------
+    hit: Hit object for the convex/concave/zero curvature case
+    """
+
+    curv = np.asarray(curv, dtype=float)
+
+    # vector from the surface's vertex to the ray's starting point
+    d = p - z0
+    d_z = d[..., 2]
+    k_z = k_hat[..., 2]
+
+    # intercepts satisfy curv*|d + l*k|^2 - 2*(d_z + l*k_z) = 0,
+    # which also holds for zero curvature, where it is the plane itself
+    b = k_z - curv*_dot(d, k_hat)
+    c = curv*_dot(d, d) - 2*d_z
+    disc_sq = b**2 - curv*c
+
+    real = disc_sq >= 0  # no real solutions so no intercept
+
+    # both roots, written so that neither loses accuracy to cancellation,
+    # even for rays almost perpendicular to the axis or for curvatures
+    # near zero, where the first tends to the plane and the second to
+    # infinity
+    q = b + np.copysign(np.sqrt(np.where(real, disc_sq, 0)), b)
+    real &= q != 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        near = np.where(real, c, 0) / np.where(real, q, 1)
+        far = q / curv
+
+        # taking the root on the hemisphere facing the vertex, or the
+        # first one for a convex surface (the second for a concave one)
+        # when the ray crosses that hemisphere twice
+        near_ok = curv*(d_z + near*k_z) <= 1
+        far_ok = curv*(d_z + far*k_z) <= 1
+
+    both = np.where(curv > 0, np.fmin(near, far), np.fmax(near, far))
+    dist = np.where(near_ok & far_ok, both, np.where(far_ok, far, near))
+    dist = np.where(real, dist, 0)
+
+    intercept = p + dist[..., np.newaxis]*k_hat
+
+    # ray misses the lens, outside its aperture or beyond the rim
+    # of the hemisphere facing the vertex
+    offset = intercept - z0
+    outside = outside_circle(offset[..., 0], offset[..., 1], ap_rad_sq)
+    outside |= curv*offset[..., 2] > 1
+
+    status = np.where(outside, rt.VIGNETTED, rt.ALIVE)
+    status = np.where(real, status, rt.MISSED)
+
+    # the unit normal (O - intercept)/R faces along +z
+    # for the convex, concave and zero curvature cases
+    normal = (z0 - intercept)*curv[..., np.newaxis]
+    normal[..., 2] += 1
+
+    return Hit(intercept, normal, dist, status)
+
+
+def _sphere_hit_single(p, k, z0, curv, ap_rad_sq):
+    """
+    A function that finds the first valid intercept of a single ray with
+    a spherical surface, as sphere_hit does, using scalar arithmetic,
+    which is much quicker than array operations for a single ray
+
+    Parameters
+    ----------
+    p: start point of the ray
+
+    k: direction vector of the ray, which need not be normalised
+
+    z0: 3D vector for the intercept of the surface with the z-axis
+
+    curv: the curvature of the surface defined by 1/radius of curvature
+
+    ap_rad_sq: the square of the maximum extent of the surface from its
+               axis
+
+    Returns
+    -------
+    hit: Hit object for the convex/concave/zero curvature case
+    """
+
+    p_x, p_y, p_z = (float(v) for v in p)
+    k_x, k_y, k_z = (float(v) for v in k)
+    z0_x, z0_y, z0_z = (float(v) for v in z0)
+    curv = float(curv)
+
+    norm = math.sqrt(k_x*k_x + k_y*k_y + k_z*k_z)
+    k_x, k_y, k_z = k_x/norm, k_y/norm, k_z/norm
+
+    # solving the same quadratic as sphere_hit, for the same root
+    d_x, d_y, d_z = p_x - z0_x, p_y - z0_y, p_z - z0_z
+
+    b = k_z - curv*(d_x*k_x + d_y*k_y + d_z*k_z)
+    c = curv*(d_x*d_x + d_y*d_y + d_z*d_z) - 2*d_z
+    disc_sq = b*b - curv*c
+
+    real = disc_sq >= 0
+
+    if real:
+        q = b + math.copysign(math.sqrt(disc_sq), b)
+        real = q != 0
+
+    dist = 0.0
+
+    if real:
+        dist = c/q
+
+        if curv != 0:
+            far = q/curv
+            far_ok = curv*(d_z + far*k_z) <= 1
+
+            if curv*(d_z + dist*k_z) > 1:
+                if far_ok:
+                    dist = far
+            elif far_ok:
+                dist = min(dist, far) if curv > 0 else max(dist, far)
+
+    x, y, z = p_x + dist*k_x, p_y + dist*k_y, p_z + dist*k_z
+
+    if not real:
+        status = rt.MISSED
+    elif (outside_circle(x - z0_x, y - z0_y, ap_rad_sq) or
+          curv*(z - z0_z) > 1):
+        status = rt.VIGNETTED
     else:
-        mu = n1/n2
+        status = rt.ALIVE
+
+    normal = np.array([(z0_x - x)*curv, (z0_y - y)*curv,
+                       (z0_z - z)*curv + 1])
+
+    return Hit(np.array([x, y, z]), normal, dist, status)
+
+
+def outside_circle(x, y, ap_rad_sq, inner_rad_sq=0):
+    """
+    A function that tests which points lie outside a circular
+    (or annular) aperture, comparing squared radii so no square root
+    is needed
+
+    Parameters
+    ----------
+    x, y: arrays of the coordinates of the points from the aperture's centre
+
+    ap_rad_sq: the square of the outer radius of the aperture
+
+    inner_rad_sq: the square of the radius of the central obstruction
+                  of an annulus
+
+    Returns
+    -------
+    boolean array that is True for each point outside the aperture
+    """
+
+    r_sq = x*x + y*y
 
-        # using equation for Snell's law in 3D
+    return (r_sq > ap_rad_sq) | (r_sq < inner_rad_sq)
 
-        a = (np.sqrt(1-((mu**2)*(1 - (np.dot(k1_hat, n_hat)**2))))) * n_hat
-        b = mu * (k1_hat - ((np.dot(k1_hat, n_hat))*n_hat))
 
-        k2_hat = a + b
+def outside_rectangle(x, y, half_width, half_height):
+    """
+    A function that tests which points lie outside a rectangular aperture
+
+    Parameters
+    ----------
+    x, y: arrays of the coordinates of the points from the aperture's centre
 
-        return k2_hat
+    half_width: half the width of the aperture along x
+
+    half_height: half the height of the aperture along y
+
+    Returns
+    -------
+    boolean array that is True for each point outside the aperture
+    """
+
+    return (np.abs(x) > half_width) | (np.abs(y) > half_height)
+
+
+def stop_hit(p, k_hat, z, ap_rad_sq=np.inf, inner_rad_sq=0,
+             half_width=np.inf, half_height=np.inf):
+    """
+    A function that finds the intercept of a ray, or of every row
+    of an (N, 3) array of rays, with a stop perpendicular to the z-axis,
+    centred on the axis, which only lets through the rays inside
+    both its circular (or annular) and its rectangular aperture
+
+    Parameters
+    ----------
+    p: start point of the ray, or (N, 3) array of them
+
+    k_hat: unit direction vector of the ray, or (N, 3) array of them
+
+    z: z-coordinate at which the stop is positioned
+
+    ap_rad_sq: the square of the outer radius of the circular aperture
+
+    inner_rad_sq: the square of the radius of the central obstruction
+                  of an annulus
+
+    half_width, half_height: half the size of the rectangular aperture
+
+    Returns
+    -------
+    hit: Hit object for the stop, VIGNETTED for rays that are blocked
+    """
+
+    hit = plane_hit(p, k_hat, z)
+
+    x = hit.point[..., 0]
+    y = hit.point[..., 1]
+
+    blocked = outside_circle(x, y, ap_rad_sq, inner_rad_sq)
+    blocked |= outside_rectangle(x, y, half_width, half_height)
+
+    return Hit(hit.point, hit.normal, hit.distance,
+               np.where(blocked, rt.VIGNETTED, rt.ALIVE).astype(np.int8))
+
+
+def plane_hit(p, k_hat, z):
+    """
+    A function that finds the intercept of a ray, or of every row
+    of an (N, 3) array of rays, with a plane perpendicular to the z-axis
+
+    Parameters
+    ----------
+    p: start point of the ray, or (N, 3) array of them
+
+    k_hat: unit direction vector of the ray, or (N, 3) array of them
+
+    z: z-coordinate at which the plane is positioned
+
+    Returns
+    -------
+    hit: Hit object for the plane, which every ray hits
+    """
+
+    dist = (z - p[..., 2]) / k_hat[..., 2]
+    intercept = p + dist[..., np.newaxis]*k_hat
+
+    normal = np.zeros_like(intercept)
+    normal[..., 2] = 1
+
+    return Hit(intercept, normal, dist,
+               np.full(np.shape(dist), rt.ALIVE, dtype=np.int8))
+
+
+def refract_batch(batch, hit, n1=None, n2=None, scratch=None, mu=None):
+    """
+    A function that moves every ray of a batch to its hit on a surface
+    and refracts it there, stopping the rays that miss the surface
+    or undergo total internal reflection
+
+    Parameters
+    ----------
+    batch: object of the RayBatch class
+
+    hit: Hit object for the batch at the surface
+
+    n1: the refractive index one side of the surface,
+        None if the surface does not refract the rays
+
+    n2: the refractive index for the other side of the surface
+
+    scratch: optional SnellScratch object for snell_batch to work in
+
+    mu: the ratio n1/n2, if it is already known
+    """
+
+    p = batch.p()
+    k = batch.k()
+
+    batch.terminate(~hit.valid, hit.status)
+
+    if n1 is None:  # only normalise the directions
+        new_dir = normalise(k)
+    else:
+        if mu is None:
+            mu = n1/n2
+
+        new_dir, tir = snell_batch(k, hit.normal, mu, scratch=scratch)
+        batch.terminate(tir, rt.TIR)
+
+    # rays that are no longer propagating keep their last point
+    alive = batch.alive()[:, np.newaxis]
+    intercept = np.where(alive, hit.point, p)
+    new_dir = np.where(alive, new_dir, k)
+
+    batch.append(intercept, new_dir, n=n2)
+
+    return batch
 
 # %%
 
 
+class Hit:
+
+    """
+    Class for the record of a ray, or batch of rays, hitting a surface
+    """
+
+    def __init__(self, point, normal, distance, status):
+        """
+        Parameters
+        ----------
+        point: the intercept of the ray with the surface
+
+        normal: unit normal to the surface at the intercept,
+                facing along the direction of propagation
+
+        distance: distance travelled by the ray to reach the intercept
+
+        status: ALIVE if the ray has a valid intercept with the surface,
+                otherwise the reason it has none (VIGNETTED or MISSED)
+        """
+
+        self.point = point
+        self.normal = normal
+        self.distance = distance
+        self.status = status
+        self.valid = status == rt.ALIVE
+
+
 class OpticalElement:
 
     """
@@ -92,18 +657,78 @@ class OpticalElement:
 
         return self
 
-    def propagate_rays(self, rays):
+    def propagate_batch(self, batch):
+        """
+        propagates every ray of a batch through the optical element
+        at once using array operations
+
+        Parameters
+        ----------
+        batch: object of the RayBatch class
+        """
+
+        raise NotImplementedError()
+
+        return self
+
+    @pf.instrument
+    def propagate_rays(self, rays, workers=None):
         """
         Method to propagate a beam of rays through an optical element
 
         Parameters
         ----------
         rays : list of ray objects in the collimated beam,
-               each with a starting point and starting direction
+               each with a starting point and starting direction,
+               or a RayBatch object which is propagated all at once,
+               a list being propagated ray by ray by elements that only
+               define propagate_ray
+
+        workers : number of processes to split a RayBatch between,
+                  by default it is propagated in this process,
+                  a list of rays cannot be split
         """
 
-        for ray in rays:
-            self.propagate_ray(ray)
+        if isinstance(rays, rt.RayBatch):
+            if workers:
+                st.trace_sharded([self], rays, workers)
+                return self
+
+            return self.propagate_batch(rays)
+
+        if workers:
+            raise Exception('Only a RayBatch can be split between workers, '
+                            'not a list of rays')
+
+        if type(self).propagate_batch is OpticalElement.propagate_batch:
+            # element only propagates single rays
+            for ray in rays:
+                self.propagate_ray(ray)
+
+            return self
+
+        history, rows = rt.RayHistory.shared(rays)
+
+        if history is not None:  # views are gathered from their arrays
+            batch = history.gather(rows)
+            self.propagate_batch(batch)
+            history.scatter(rows, batch)
+            return self
+
+        # gathering the rays into a batch to propagate them all at once
+        batch = rt.RayBatch.from_rays(rays, history=False)
+        self.propagate_batch(batch)
+
+        status = batch.status()
+
+        for i, ray in enumerate(rays):
+            if not ray.alive():  # ray was stopped at an earlier element
+                continue
+
+            if status[i] == rt.ALIVE:
+                ray.append(batch.p()[i], batch.k()[i])
+            else:
+                ray.terminate(int(status[i]))
 
         return self
 
@@ -126,7 +751,8 @@ class SphericalRefraction(OpticalElement):
 
         n2: the refractive index for the other side of the surface
 
-        ap_rad: the maximum extent of the surface from the optical axis
+        ap_rad: the maximum extent of the surface from its axis,
+                the radial distance from the vertex
         """
 
         self._z0 = np.array(z0)
@@ -135,66 +761,56 @@ class SphericalRefraction(OpticalElement):
         self._n2 = n2
         self._ap_rad = ap_rad
 
-    def intercept(self, ray):
+    def hit(self, ray):
         """
-        Method to return the first valid intercept
-        of a ray with the spherical surface
+        Method to find, in a single pass, the first valid intercept
+        of a ray (or of every ray in a batch) with the spherical surface
+        together with the surface normal there
 
         Parameters
         ----------
-        ray: object of the ray class
+        ray: object of the ray class or of the RayBatch class
 
         Returns
         -------
-        intercept: the intercept for the appropriate
-                   convex/concave/zero curvature case
+        hit: Hit object with the intercept, normal, distance travelled
+             and status of the intercept, as arrays for a batch
         """
 
-        p = ray._points[-1]  # using the last point of the ray as start point
-
-        # unit vector in the direction of the incident ray
-        k_hat = normalise(ray._directions[-1])
-
-        if self._curv == 0:  # zero curvature case
-            intercept = p + ((self._z0[2] - p[2])/k_hat[2]*k_hat)
-
-            if intercept[0] > self._ap_rad:  # ray misses the lens in this case
-                raise Exception('There is no intercept')
-
-            return intercept
-
-        else:
-            R = 1/self._curv  # radius of spherical surface
-
-            # vector from the sphere’s centre O to the ray’s starting point
-            r = p - (self._z0 + np.array([0, 0, R]))
-
-            disc = np.sqrt((np.dot(r, k_hat))**2 - (np.dot(r, r) - R**2))
+        if not isinstance(ray, rt.RayBatch):
+            return _sphere_hit_single(ray.p(), ray.k(), self._z0, self._curv,
+                                      self._ap_rad**2)
 
-            if disc < 0:
-                raise Exception("No real solutions so no intercept")
+        # using the last point of the ray as start point
+        p = np.asarray(ray.p(), dtype=float)
 
-            else:
-
-                if self._curv > 0:  # convex case
+        # unit vector in the direction of the incident ray
+        k_hat = normalise(np.asarray(ray.k(), dtype=float))
 
-                    l_1 = -np.dot(r, k_hat) - disc
-                    intercept = p + (l_1*k_hat)
+        return sphere_hit(p, k_hat, self._z0, self._curv, self._ap_rad**2)
 
-                    if abs(intercept[0]) > self._ap_rad:  # ray misses the lens
-                        raise Exception('There is no intercept')
+    def intercept(self, ray):
+        """
+        Method to return the first valid intercept
+        of a ray with the spherical surface
 
-                    return intercept
+        Parameters
+        ----------
+        ray: object of the ray class
 
-                elif self._curv < 0:  # concave case
+        Returns
+        -------
+        intercept: the intercept for the appropriate
+                   convex/concave/zero curvature case,
+                   None if the ray misses the surface
+        """
 
-                    l_2 = -np.dot(r, k_hat) + disc
-                    intercept = p + (l_2*k_hat)
+        hit = self.hit(ray)
 
-                    if abs(intercept[0]) > self._ap_rad:  # ray misses the lens
-                        raise Exception('There is no intercept')
+        if not hit.valid:
+            return None
 
-                    return intercept
+        return hit.point
 
     def get_normal(self, ray):
         """
@@ -210,27 +826,9 @@ class SphericalRefraction(OpticalElement):
                 for the normal from the refraction at the spherical surface
         """
 
-        if self._curv != 0:  # no R value for zero curvature lens
-            R = 1/self._curv
-
-        if self._curv == 0:  # zero curvature case
-            normal = normalise([0, 0, 1])
-
-            return normal
-
-        elif self._curv > 0:  # convex case
-
-            normal = normalise((-1*self.intercept(ray)) +
-                               self._z0 + np.array([0, 0, R]))
-            return normal
-
-        elif self._curv < 0:  # concave case
+        return self.hit(ray).normal
 
-            normal = -1*normalise((-1*self.intercept(ray)) +
-                                  self._z0 + np.array([0, 0, R]))
-            return normal
-
-    def snells(self, ray):
+    def snells(self, ray, hit=None):
         """
         Method to return the refracted ray's new direction vector
         using Snell's law function
@@ -239,26 +837,64 @@ class SphericalRefraction(OpticalElement):
         ----------
         ray: object of the ray class
 
+        hit: Hit object for the ray at this surface, found if not given
+
         Returns
         -------
         new_dir: the refracted ray direction vector
         """
 
-        new_dir = snell(ray._directions[-1],
-                        self.get_normal(ray), self._n1, self._n2)
+        if hit is None:
+            hit = self.hit(ray)
+
+        new_dir = snell(ray.k(), hit.normal, self._n1, self._n2)
 
         return new_dir
 
+    @pf.instrument
     def propagate_ray(self, ray):
         """
-        Method propagates a ray through the spherical optical element
+        Method propagates a ray through the spherical optical element,
+        stopping the ray if it misses the surface or is totally
+        internally reflected
 
         Parameters
         ----------
         ray: object of the ray class
         """
 
-        ray.append(self.intercept(ray), self.snells(ray))
+        if not ray.alive():  # ray was stopped at an earlier element
+            return self
+
+        hit = self.hit(ray)
+
+        if not hit.valid:
+            ray.terminate(int(hit.status))
+            return self
+
+        new_dir = _snell_single(ray.k(), hit.normal, self._n1, self._n2)
+
+        if new_dir is None:  # total internal reflection
+            ray.terminate(rt.TIR)
+            return self
+
+        ray.append(hit.point, new_dir)
+
+        return self
+
+    @pf.instrument
+    def propagate_batch(self, batch):
+        """
+        Method propagates every ray of a batch through the spherical
+        optical element at once, finding the intercepts, normals and
+        refracted directions as array operations
+
+        Parameters
+        ----------
+        batch: object of the RayBatch class
+        """
+
+        refract_batch(batch, self.hit(batch), self._n1, self._n2)
 
         return self
 
@@ -304,6 +940,26 @@ class OutputPlane(OpticalElement):
         self._z = z
         OpticalElement.__init__(self)
 
+    def hit(self, ray):
+        """
+        Method finds the intercept of a ray (or of every ray in a batch)
+        with the output plane together with the plane's normal
+
+        Parameters
+        ----------
+        ray : object of the ray class or of the RayBatch class
+
+        Returns
+        -------
+        hit : Hit object with the intercept, normal, distance travelled
+              and status of the intercept, as arrays for a batch
+        """
+
+        p = np.asarray(ray.p(), dtype=float)
+        k_hat = normalise(np.asarray(ray.k(), dtype=float))
+
+        return plane_hit(p, k_hat, self._z)
+
     def intercept(self, ray):
         """
         Method finds the intercept of the ray at the output plane
@@ -317,8 +973,11 @@ class OutputPlane(OpticalElement):
         intercept : the point where the ray meets the output plane
         """
 
-        dist = (self._z - ray._points[-1][-1]) / ray._directions[-1][-1]
-        intercept = ray._points[-1] + (dist * ray._directions[-1])
+        p = np.asarray(ray.p(), dtype=float)
+        k = np.asarray(ray.k(), dtype=float)
+
+        dist = (self._z - p[-1]) / k[-1]
+        intercept = p + (dist * k)
 
         return intercept
 
@@ -356,11 +1015,11 @@ class OutputPlane(OpticalElement):
                   no refraction occurs)
         """
 
-        new_dir = snell(ray._directions[-1],
-                        self.get_normal(ray), 1, 1)
+        new_dir = snell(ray.k(), self.get_normal(ray), 1, 1)
 
         return new_dir
 
+    @pf.instrument
     def propagate_ray(self, ray):
         """
         Method propagates a ray through the output plane
@@ -370,10 +1029,29 @@ class OutputPlane(OpticalElement):
         ray : object of the ray class
         """
 
+        if not ray.alive():  # ray was stopped at an earlier element
+            return self
+
         ray.append(self.intercept(ray), self.snells(ray))
 
         return self
 
+    @pf.instrument
+    def propagate_batch(self, batch):
+        """
+        Method propagates every ray of a batch through the output plane
+        at once
+
+        Parameters
+        ----------
+        batch : object of the RayBatch class
+        """
+
+        # the output plane does not refract the rays
+        refract_batch(batch, self.hit(batch))
+
+        return self
+
     def redefine_z(self, new_z):
         """
         Method to change the position of the output plane
@@ -390,3 +1068,97 @@ class OutputPlane(OpticalElement):
         self._z = new_z
 
         return self._z
+
+
+class Stop(OpticalElement):
+
+    """
+    Derived class of OpticalElement for a stop perpendicular to the z-axis,
+    which blocks the rays falling outside its aperture without refracting
+    the rest
+    """
+
+    def __init__(self, z=0, ap_rad=np.inf, inner_rad=0, half_width=np.inf,
+                 half_height=np.inf):
+        """
+        Parameters
+        ----------
+        z : z-coordinate at which the stop is positioned
+
+        ap_rad : outer radius of a circular or annular aperture
+
+        inner_rad : radius of the central obstruction of an annular aperture
+
+        half_width, half_height : half the size of a rectangular aperture
+        """
+
+        if inner_rad >= ap_rad:
+            raise Exception('Inner radius of the stop must be smaller than'
+                            ' its outer radius')
+
+        self._z = z
+        self._ap_rad = ap_rad
+        self._inner_rad = inner_rad
+        self._half_width = half_width
+        self._half_height = half_height
+        OpticalElement.__init__(self)
+
+    def hit(self, ray):
+        """
+        Method finds the intercept of a ray (or of every ray in a batch)
+        with the stop, and whether it passes through the aperture
+
+        Parameters
+        ----------
+        ray : object of the ray class or of the RayBatch class
+
+        Returns
+        -------
+        hit : Hit object, VIGNETTED for rays that are blocked
+        """
+
+        p = np.asarray(ray.p(), dtype=float)
+        k_hat = normalise(np.asarray(ray.k(), dtype=float))
+
+        return stop_hit(p, k_hat, self._z, self._ap_rad**2,
+                        self._inner_rad**2, self._half_width,
+                        self._half_height)
+
+    @pf.instrument
+    def propagate_ray(self, ray):
+        """
+        Method propagates a ray through the stop, stopping it
+        if it falls outside the aperture
+
+        Parameters
+        ----------
+        ray : object of the ray class
+        """
+
+        if not ray.alive():  # ray was stopped at an earlier element
+            return self
+
+        hit = self.hit(ray)
+
+        if not hit.valid:
+            ray.terminate(int(hit.status))
+            return self
+
+        ray.append(hit.point, normalise(np.asarray(ray.k(), dtype=float)))
+
+        return self
+
+    @pf.instrument
+    def propagate_batch(self, batch):
+        """
+        Method propagates every ray of a batch through the stop at once
+
+        Parameters
+        ----------
+        batch : object of the RayBatch class
+        """
+
+        # the stop does not refract the rays that pass through it
+        refract_batch(batch, self.hit(batch))
+
+        return self
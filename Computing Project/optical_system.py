@@ -0,0 +1,333 @@
+"""
+optical_system.py
+agent, 18/10/26
+Module to compile a sequence of optical elements into a single system
+that traces a batch of rays through every element in one call
+"""
+
+import hashlib
+
+import numpy as np
+import raytracer as rt
+import optical_elements as oe
+import profiling as pf
+import sharded_trace as st
+
+# kinds of surface in a compiled system
+REFRACTING = 0  # spherical (or zero curvature) refracting surface
+OUTPUT = 1  # output plane, where the rays are not refracted
+STOP = 2  # stop, which blocks the rays outside its aperture
+
+# batches are compacted once fewer than this fraction of their rays
+# are still propagating
+COMPACT = 0.7
+
+
+class OpticalSystem:
+    """
+    Class for a sequence of SphericalRefraction and OutputPlane elements,
+    with the constants of every surface packed into arrays
+    """
+
+    def __init__(self, elems):
+        """
+        Parameters
+        ----------
+        elems: list of SphericalRefraction, Stop and OutputPlane objects,
+               in the order the rays pass through them
+        """
+
+        self._elems = list(elems)
+        self.compile()
+
+    def __len__(self):
+
+        return len(self._elems)
+
+    def elements(self):
+        """
+        Method returns the optical elements making up the system
+
+        Returns
+        -------
+        list of the optical elements in the order the rays pass through them
+        """
+
+        return self._elems
+
+    def compile(self):
+        """
+        Method packs the constants of every surface into arrays,
+        it must be called again if any of the elements are changed
+        (for example after OutputPlane.redefine_z)
+        """
+
+        n_surf = len(self._elems)
+
+        self._kind = np.empty(n_surf, dtype=np.int8)
+        self._z0 = np.zeros((n_surf, 3))  # vertex of each surface
+        self._curv = np.zeros(n_surf)
+        self._n1 = np.ones(n_surf)
+        self._n2 = np.ones(n_surf)
+        self._ap_rad = np.full(n_surf, np.inf)
+        self._inner_rad = np.zeros(n_surf)  # central obstruction of stops
+        self._half_size = np.full((n_surf, 2), np.inf)  # rectangular stops
+
+        for i, elem in enumerate(self._elems):
+
+            if isinstance(elem, oe.SphericalRefraction):
+                self._kind[i] = REFRACTING
+                self._z0[i] = elem._z0
+                self._curv[i] = elem._curv
+                self._n1[i] = elem._n1
+                self._n2[i] = elem._n2
+                self._ap_rad[i] = elem._ap_rad
+
+            elif isinstance(elem, oe.OutputPlane):
+                self._kind[i] = OUTPUT
+                self._z0[i, 2] = elem._z
+
+            elif isinstance(elem, oe.Stop):
+                self._kind[i] = STOP
+                self._z0[i, 2] = elem._z
+                self._ap_rad[i] = elem._ap_rad
+                self._inner_rad[i] = elem._inner_rad
+                self._half_size[i] = elem._half_width, elem._half_height
+
+            else:
+                raise Exception('Cannot compile element of type %s'
+                                % type(elem).__name__)
+
+        # worked out once here rather than for every batch of rays
+        self._ap_rad_sq = np.square(self._ap_rad)
+        self._inner_rad_sq = np.square(self._inner_rad)
+        self._mu = self._n1 / self._n2
+
+        return self
+
+    def fingerprint(self):
+        """
+        Method to return a hash identifying the compiled surfaces,
+        so traces through identical systems can be recognised
+
+        Returns
+        -------
+        hexadecimal SHA-256 digest of the packed constants
+        """
+
+        digest = hashlib.sha256()
+
+        for values in (self._kind, self._z0, self._curv, self._n1, self._n2,
+                       self._ap_rad, self._inner_rad, self._half_size):
+            digest.update(np.ascontiguousarray(values).tobytes())
+            digest.update(b'|')
+
+        return digest.hexdigest()
+
+    def trace(self, rays, workers=None, compact=COMPACT):
+        """
+        Method traces rays through every element of the system in order
+
+        Parameters
+        ----------
+        rays: RayBatch object, or list of ray objects which are
+              propagated one at a time through each element
+
+        workers: number of processes to split a RayBatch between,
+                 by default it is traced in this process, a list of rays
+                 cannot be split
+
+        compact: the rays still propagating in a RayBatch are packed into
+                 a smaller batch before a surface whenever they make up
+                 less than this fraction of it, 0 to never compact,
+                 the results are written back to the rays in their
+                 original order
+
+        Returns
+        -------
+        rays: the propagated rays
+        """
+
+        if not isinstance(rays, rt.RayBatch):
+            if workers:
+                raise Exception('Only a RayBatch can be split between '
+                                'workers, not a list of rays')
+
+            for elem in self._elems:
+                elem.propagate_rays(rays)
+
+            return rays
+
+        if workers:
+            return st.trace_sharded(self, rays, workers)
+
+        work = rays
+        rows = None  # rows of the rays in work, None while work is rays
+        scratch = oe.SnellScratch()  # reused at every surface
+
+        for i in range(len(self._kind)):
+            alive = work.alive()
+
+            if compact and np.count_nonzero(alive) < compact * len(work):
+                if rows is not None:
+                    self._scatter(rays, work, rows)
+
+                rows = np.flatnonzero(alive) if rows is None else rows[alive]
+                work = work.compact(alive)
+
+            self.trace_surface(work, i, scratch)
+
+            if rows is not None and rays._history is not None:
+                self._scatter(rays, work, rows, vertex=True)
+
+        if rows is not None:
+            self._scatter(rays, work, rows)
+
+        return rays
+
+    def _scatter(self, rays, work, rows, vertex=False):
+        """
+        Method writes the rays of a compacted batch back into the rows of
+        the batch it was taken from, where the stopped rays stay put
+
+        Parameters
+        ----------
+        rays: RayBatch object the rays were compacted from
+
+        work: compacted RayBatch object
+
+        rows: array of the row of each compacted ray in rays
+
+        vertex: if True, the points are added to the ray history as a new
+                vertex, otherwise the state of the rays is brought up to date
+        """
+
+        points = np.array(rays.p())
+        directions = np.array(rays.k())
+        points[rows] = work.p()
+        directions[rows] = work.k()
+
+        rays._points = points
+        rays._directions = directions
+
+        if vertex:
+            rays._history.append(points)
+            rays._history_dirs.append(directions)
+            return
+
+        rays._status[rows] = work.status()
+        rays._opl[rows] = work.opl()
+        rays._n[rows] = work._n
+
+    def trace_surface(self, batch, i, scratch=None):
+        """
+        Method propagates a batch of rays through a single surface
+        of the system using its packed constants
+
+        Parameters
+        ----------
+        batch: object of the RayBatch class
+
+        i: index of the surface in the system
+
+        scratch: optional SnellScratch object to refract the rays in
+        """
+
+        profiler = pf.active()
+
+        if profiler is not None:
+            return profiler.record(self._elems[i], self._trace_surface,
+                                   batch, batch, i, scratch)
+
+        return self._trace_surface(batch, i, scratch)
+
+    def _trace_surface(self, batch, i, scratch=None):
+        """
+        Method propagates a batch of rays through a single surface,
+        without profiling
+
+        Parameters
+        ----------
+        batch: object of the RayBatch class
+
+        i: index of the surface in the system
+
+        scratch: optional SnellScratch object to refract the rays in
+        """
+
+        hit = self.hit(batch.p(), oe.normalise(batch.k()), i)
+
+        if self._kind[i] == REFRACTING:
+            oe.refract_batch(batch, hit, self._n1[i], self._n2[i], scratch,
+                             self._mu[i])
+        else:
+            oe.refract_batch(batch, hit)
+
+        return batch
+
+    def hit(self, p, k_hat, i):
+        """
+        Method finds where rays meet a single surface of the system
+
+        Parameters
+        ----------
+        p: (N, 3) array of start points of the rays
+
+        k_hat: (N, 3) array of unit direction vectors of the rays
+
+        i: index of the surface in the system
+
+        Returns
+        -------
+        hit: Hit object for the rays with the surface
+        """
+
+        if self._kind[i] == OUTPUT:
+            return oe.plane_hit(p, k_hat, self._z0[i, 2])
+
+        if self._kind[i] == STOP:
+            return oe.stop_hit(p, k_hat, self._z0[i, 2], self._ap_rad_sq[i],
+                               self._inner_rad_sq[i], *self._half_size[i])
+
+        return oe.sphere_hit(p, k_hat, self._z0[i], self._curv[i],
+                             self._ap_rad_sq[i])
+
+    def stream(self, batches, accumulator=None):
+        """
+        Method traces batches of rays one after the other, only keeping the
+        final points or running statistics, so memory use does not grow
+        with the total number of rays
+
+        Parameters
+        ----------
+        batches: iterable of RayBatch objects, such as
+                 Bundle.iter_batches(chunk_size)
+
+        accumulator: object with an add(batch) method that is given each
+                     traced batch to update its running statistics
+
+        Returns
+        -------
+        the accumulator if one is given, otherwise an (M, 3) array of the
+        final points of every ray still propagating
+        """
+
+        final = []
+
+        for batch in batches:
+            batch._history = None  # no need to keep the earlier vertices
+
+            self.trace(batch)
+
+            if accumulator is None:
+                final.append(batch.p()[batch.alive()])
+            else:
+                accumulator.add(batch)
+
+        if accumulator is not None:
+            return accumulator
+
+        if not final:
+            return np.empty((0, 3))
+
+        return np.concatenate(final)
@@ -0,0 +1,237 @@
+"""
+paraxial.py
+agent, 18/10/26
+Module for paraxial (ray transfer matrix) analysis of a sequence of
+spherical refracting surfaces, giving the focal length, focal points,
+principal planes and magnification without tracing any rays
+"""
+
+import numpy as np
+import optical_elements as oe
+import optical_system as osys
+
+
+def system_matrix(z, curv, n1, n2):
+    """
+    Function that multiplies the ray transfer matrices of a sequence of
+    refracting surfaces, from the vertex of the first surface to the vertex
+    of the last, acting on (height, refractive index * angle) of a ray
+
+    Parameters
+    ----------
+    z: array of the z-coordinate of the vertex of each surface
+
+    curv: array of the curvature of each surface
+
+    n1: array of the refractive index before each surface
+
+    n2: array of the refractive index after each surface
+
+    the arrays have the surfaces along their last axis and any leading
+    axes are broadcast, so many designs can be found at once
+
+    Returns
+    -------
+    a, b, c, d: elements of the system matrix [[a, b], [c, d]]
+    """
+
+    z, curv, n1, n2 = np.broadcast_arrays(*(np.asarray(v, dtype=float)
+                                            for v in (z, curv, n1, n2)))
+
+    a = np.ones(z.shape[:-1])
+    b = np.zeros(z.shape[:-1])
+    c = np.zeros(z.shape[:-1])
+    d = np.ones(z.shape[:-1])
+
+    for i in range(z.shape[-1]):
+
+        if i > 0:  # transfer from the previous vertex
+            t = (z[..., i] - z[..., i-1]) / n2[..., i-1]
+            a, b = a + t*c, b + t*d
+
+        power = (n2[..., i] - n1[..., i]) * curv[..., i]  # refraction
+        c, d = c - power*a, d - power*b
+
+    return a, b, c, d
+
+
+class ParaxialSystem:
+    """
+    Class for the paraxial properties of the refracting surfaces of an
+    optical system, found from its system matrix
+    """
+
+    def __init__(self, elems):
+        """
+        Parameters
+        ----------
+        elems: list of SphericalRefraction and OutputPlane objects,
+               or an OpticalSystem object, output planes are ignored
+        """
+
+        if not isinstance(elems, osys.OpticalSystem):
+            elems = osys.OpticalSystem([elem for elem in elems if
+                                        isinstance(elem,
+                                                   oe.SphericalRefraction)])
+
+        refracting = elems._kind == osys.REFRACTING
+
+        if not np.any(refracting):
+            raise Exception('System has no refracting surfaces')
+
+        self._z = elems._z0[refracting, 2]
+        self._n_in = elems._n1[refracting][0]
+        self._n_out = elems._n2[refracting][-1]
+
+        self._abcd = system_matrix(self._z, elems._curv[refracting],
+                                   elems._n1[refracting],
+                                   elems._n2[refracting])
+
+    def matrix(self):
+        """
+        Method returns the system matrix, from the first to the last vertex
+
+        Returns
+        -------
+        2x2 array acting on (height, refractive index * angle) of a ray
+        """
+
+        a, b, c, d = self._abcd
+
+        return np.array([[a, b], [c, d]])
+
+    def power(self):
+        """
+        Method returns the optical power of the system
+
+        Returns
+        -------
+        power: inverse of the effective focal length
+        """
+
+        return -self._abcd[2]
+
+    def efl(self):
+        """
+        Method returns the effective focal length of the system,
+        equal to the focal lengths of a system in air
+
+        Returns
+        -------
+        efl: inverse of the power, infinite for an afocal system
+        """
+
+        with np.errstate(divide='ignore'):
+            return 1 / self.power()
+
+    def bfd(self):
+        """
+        Method returns the back focal distance of the system
+
+        Returns
+        -------
+        bfd: distance from the vertex of the last surface to the focus
+             of a beam parallel to the optical axis
+        """
+
+        a, b, c, d = self._abcd
+
+        return -a * self._n_out / c
+
+    def ffd(self):
+        """
+        Method returns the front focal distance of the system
+
+        Returns
+        -------
+        ffd: distance from the front focal point to the vertex of the
+             first surface
+        """
+
+        a, b, c, d = self._abcd
+
+        return -d * self._n_in / c
+
+    def focus(self):
+        """
+        Method finds the paraxial focus of a beam parallel to the optical
+        axis, as found by SphericalRefraction.paraxial_focus, where the
+        output plane can be placed
+
+        Returns
+        -------
+        z: the z-coordinate of the back focal point
+        """
+
+        return self._z[-1] + self.bfd()
+
+    def focal_points(self):
+        """
+        Method finds the front and back focal points of the system
+
+        Returns
+        -------
+        z_front, z_back: z-coordinates of the front and back focal points
+        """
+
+        return self._z[0] - self.ffd(), self.focus()
+
+    def principal_planes(self):
+        """
+        Method finds the front and back principal planes of the system
+
+        Returns
+        -------
+        z_front, z_back: z-coordinates of the front and back principal planes
+        """
+
+        a, b, c, d = self._abcd
+
+        return (self._z[0] + self._n_in * (d - 1) / c,
+                self._z[-1] + self._n_out * (1 - a) / c)
+
+    def image(self, z_object):
+        """
+        Method finds the paraxial image of an object on the optical axis
+
+        Parameters
+        ----------
+        z_object: z-coordinate of the object before the first surface,
+                  -np.inf for an object at infinity
+
+        Returns
+        -------
+        z_image: z-coordinate of the image
+
+        magnification: transverse magnification of the image
+        """
+
+        a, b, c, d = self._abcd
+
+        # reduced distance from the object to the first vertex
+        t = (self._z[0] - np.asarray(z_object, dtype=float)) / self._n_in
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_t = np.where(np.isinf(t), 0, 1 / t)
+
+            # t_image solves b + a*t + t_image*(d + c*t) = 0
+            t_image = -(a + b*inv_t) / (c + d*inv_t)
+            magnification = inv_t / (c + d*inv_t)
+
+        return self._z[-1] + t_image * self._n_out, magnification
+
+    def magnification(self, z_object):
+        """
+        Method finds the transverse magnification of an object on the
+        optical axis
+
+        Parameters
+        ----------
+        z_object: z-coordinate of the object before the first surface
+
+        Returns
+        -------
+        magnification: ratio of the image height to the object height
+        """
+
+        return self.image(z_object)[1]
@@ -7,9 +7,58 @@ Code for plotting spot diagrams and calculating rms spot radius
 
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+import raytracer as rt
+import spot_statistics as ss
 
+# spots with more points than this are drawn as a 2D histogram
+DENSITY_THRESHOLD = 10000
 
-def plot_positions(x, y):
+
+def _finish(filename):
+    """
+    Function that shows the current figure, or saves it to a file
+    and closes it without showing it, for scripts run without a display
+
+    Parameters
+    ----------
+    filename: file to save the figure to, None to show it
+    """
+
+    if filename is None:
+        return plt.show()
+
+    plt.savefig(filename)
+    plt.close()
+
+
+def _spot(x, y, threshold, bins):
+    """
+    Function that draws a spot diagram, as a marker for each point,
+    or binned into a 2D histogram of the density of points
+    if there are more than threshold of them
+
+    Parameters
+    ----------
+    x: array of x-coordinates of the points
+
+    y: array of y-coordinates of the points
+
+    threshold: largest number of points drawn as markers
+
+    bins: number of bins along each axis of the histogram
+    """
+
+    if len(x) > threshold:
+        image = plt.hist2d(x, y, bins=bins, cmin=1)[3]
+        plt.colorbar(image, label='number of rays')
+        plt.gca().set_aspect('equal')
+    else:
+        plt.plot(x, y, 'o', color='blue')
+
+
+def plot_positions(x, y, filename=None, threshold=DENSITY_THRESHOLD,
+                   bins=200):
     """
     Function that plots x against y coordinates
     (to observe a spot diagram before refraction)
@@ -20,6 +69,14 @@ def plot_positions(x, y):
 
     y: list of y-coordinates (for bundle of rays starting points)
 
+    filename: file to save the plot to without showing it,
+              by default the plot is shown
+
+    threshold: largest number of points plotted individually,
+               larger spots are plotted as a 2D histogram
+
+    bins: number of bins along each axis of the histogram
+
     Returns
     -------
     Plot of x coordinates against y coordinates
@@ -28,12 +85,12 @@ def plot_positions(x, y):
     plt.title('Spot diagram of uniform bundle of rays before refraction')
     plt.xlabel('x / mm')
     plt.ylabel('y / mm')
-    plt.plot(x, y, 'o', color='blue')
+    _spot(np.ravel(x), np.ravel(y), threshold, bins)
 
-    return plt.show()
+    return _finish(filename)
 
 
-def plot_ray(ray):
+def plot_ray(ray, filename=None):
     """
     A function that plots the vertices of the ray
 
@@ -41,56 +98,107 @@ def plot_ray(ray):
     ----------
     ray: object of the Ray class
 
+    filename: file to save the figure to once the ray is plotted,
+              without showing it, by default it is left open
+
     Returns
     -------
     a matplotlib plot that traces the ray's path using its vertices
     """
-    z = []
-    x = []
+
+    points = np.asarray(ray.vertices(), dtype=float).reshape(-1, 3)
 
     plt.xlabel('z / mm')
     plt.ylabel('x / mm')
 
-    for i in range(len(ray._points)):
-        z.append(ray._points[i][2])
-        x.append(ray._points[i][0])
+    lines = plt.plot(points[:, 2], points[:, 0], marker='o',
+                     linestyle='dashed', linewidth=1, markersize=7)
+
+    if filename is not None:
+        _finish(filename)
 
-    return plt.plot(z, x, marker='o', linestyle='dashed', linewidth=1,
-                    markersize=7)
-    plt.grid()
-    plt.show()
+    return lines
 
 
-def spot_pf(rays):
+def plot_rays(rays, filename=None, **kwargs):
+    """
+    A function that plots the paths of a bundle of rays in the x-z plane
+    as a single collection of lines, which stays quick to draw
+    for large bundles
+
+    Parameters
+    ----------
+    rays: list of ray objects, or a RayBatch object keeping its history
+
+    filename: file to save the figure to once the rays are plotted,
+              without showing it, by default it is left open
+
+    kwargs: options for the LineCollection, such as color or linewidth
+
+    Returns
+    -------
+    the LineCollection of the ray paths
+    """
+
+    if isinstance(rays, rt.RayBatch):
+        paths = rays.vertices()[:, :, [2, 0]]
+    else:
+        paths = [np.asarray(ray.vertices(), dtype=float).reshape(-1, 3)[
+            :, [2, 0]] for ray in rays]
+
+    kwargs.setdefault('linewidth', 1)
+
+    lines = LineCollection(paths, **kwargs)
+
+    ax = plt.gca()
+    ax.add_collection(lines)
+    ax.autoscale_view()
+
+    plt.xlabel('z / mm')
+    plt.ylabel('x / mm')
+
+    if filename is not None:
+        _finish(filename)
+
+    return lines
+
+
+def spot_pf(rays, filename=None, threshold=DENSITY_THRESHOLD, bins=200):
     """
     A function that plots the spot diagram for bundle of rays
     at the paraxial focal plane
 
     Parameters
     ----------
-    rays: list of rays in the collimated beam
+    rays: list of rays in the collimated beam, or a RayBatch object,
+          where only the rays still propagating are plotted
+
+    filename: file to save the plot to without showing it,
+              by default the plot is shown
+
+    threshold: largest number of rays plotted individually,
+               larger spots are plotted as a 2D histogram
+
+    bins: number of bins along each axis of the histogram
 
     Returns
     -------
     graph of the spot diagram for the bundle of rays after refraction
     """
 
-    x_fp = []  # x values of ray at focal point
-    y_fp = []  # y values of ray at focal point
-
-    for ray in rays:
+    points = rt.final_points(rays)
 
-        x_fp.append(ray.p()[0])
-        y_fp.append(ray.p()[1])
+    x_fp = points[:, 0]  # x values of ray at focal point
+    y_fp = points[:, 1]  # y values of ray at focal point
 
     plt.xlabel('x / mm')
     plt.ylabel('y / mm')
     plt.title(
         'Corresponding spot diagram for the bundle of rays'
         '\n at the paraxial focal plane')
-    plt.plot(x_fp, y_fp, 'o', color='blue')
+    _spot(x_fp, y_fp, threshold, bins)
 
-    return plt.show()
+    return _finish(filename)
 
 
 def rms(rays):
@@ -100,22 +208,14 @@ def rms(rays):
 
     Parameters
     ----------
-    rays: list of rays in the collimated beam
+    rays: list of rays in the collimated beam, or a RayBatch object,
+          where only the rays still propagating are counted
 
     Returns
     -------
     RMS_spot_radius: RMS spot radius of the refracted beam of rays
     """
 
-    x_fp = []  # x values of ray at focal point
-    y_fp = []  # y values of ray at focal point
-
-    for ray in rays:
-
-        x_fp.append(ray.p()[0])
-        y_fp.append(ray.p()[1])
-
-    RMS_spot_radius = np.sqrt(
-        (sum((((np.array(x_fp))**2) + ((np.array(y_fp))**2))))/len(x_fp))
+    RMS_spot_radius = ss.SpotStatistics().add(rays).rms()
 
     return RMS_spot_radius
@@ -0,0 +1,260 @@
+"""
+profiling.py
+agent, 18/10/26
+Module for opt-in profiling of traces, recording the time spent and the
+rays stopped at each optical element, which costs a single check per
+call while no profiler is active
+"""
+
+import functools
+import time
+
+import numpy as np
+import raytracer as rt
+
+# profiler currently recording, None while profiling is switched off
+_active = None
+
+N_STATUS = rt.TRUNCATED + 1  # number of ray status codes
+
+
+def active():
+    """
+    Function that returns the profiler currently recording
+
+    Returns
+    -------
+    TraceProfiler object, None if profiling is switched off
+    """
+
+    return _active
+
+
+def _status_counts(rays):
+    """
+    Function that counts the rays with each status
+
+    Parameters
+    ----------
+    rays: RayBatch object, list of ray objects or a single ray object
+
+    Returns
+    -------
+    array of the number of rays with each status code
+    """
+
+    if isinstance(rays, rt.RayBatch):
+        status = rays.status()
+    elif isinstance(rays, (rt.Ray, rt.RayView)):
+        status = [rays.status()]
+    else:
+        status = [ray.status() for ray in rays]
+
+    return np.bincount(np.asarray(status, dtype=np.int64),
+                       minlength=N_STATUS)
+
+
+def instrument(method):
+    """
+    Decorator for the propagate methods of optical elements, that hands
+    each call to the active profiler, or straight to the method if there
+    is none
+
+    Parameters
+    ----------
+    method: method taking an element and its rays as its first arguments
+
+    Returns
+    -------
+    wrapped method
+    """
+
+    @functools.wraps(method)
+    def wrapper(elem, rays, *args, **kwargs):
+
+        if _active is None:
+            return method(elem, rays, *args, **kwargs)
+
+        return _active.record(elem, method, rays, elem, rays, *args,
+                              **kwargs)
+
+    return wrapper
+
+
+def _label(elem):
+    """
+    Function that describes an optical element for the report
+
+    Parameters
+    ----------
+    elem: optical element
+
+    Returns
+    -------
+    string of the type of the element and its position along z
+    """
+
+    if hasattr(elem, '_z0'):
+        z = elem._z0[2]
+    else:
+        z = getattr(elem, '_z', np.nan)
+
+    return '%s at z=%g' % (type(elem).__name__, z)
+
+
+class TraceProfiler:
+    """
+    Class for a record of the calls made to each optical element while
+    it is active, used as a context manager around the traces to profile
+
+    The worker processes of a sharded trace are not profiled, so a batch
+    an element propagates on several workers is recorded as a single call
+    and a system traced on several workers is not recorded.
+    """
+
+    FIELDS = ('calls', 'time', 'rays_in', 'rays_out', 'vignetted', 'tir',
+              'missed')
+
+    def __init__(self, callback=None):
+        """
+        Parameters
+        ----------
+        callback: function called after every recorded call with the
+                  element and a dictionary of the FIELDS for that call
+        """
+
+        self._callback = callback
+        self._stats = {}  # statistics of each element, by id
+        self._elems = {}  # elements, by id, in the order first seen
+        self._depth = 0  # nested calls are included in the outer one
+        self._previous = None
+
+    def __enter__(self):
+
+        return self.enable()
+
+    def __exit__(self, *exc):
+
+        self.disable()
+
+    def enable(self):
+        """
+        Method makes this the active profiler
+
+        Returns
+        -------
+        self, so it can be used in a with statement
+        """
+
+        global _active
+
+        self._previous = _active
+        _active = self
+
+        return self
+
+    def disable(self):
+        """
+        Method stops this profiler, making the one that was active
+        before it active again
+        """
+
+        global _active
+
+        _active = self._previous
+        self._previous = None
+
+    def record(self, elem, func, rays, *args, **kwargs):
+        """
+        Method calls a function propagating rays through an element,
+        recording the time taken and how many rays it stopped
+
+        Parameters
+        ----------
+        elem: optical element the rays are propagated through
+
+        func: function to call
+
+        rays: RayBatch object, list of ray objects or ray object
+              propagated by the function
+
+        args, kwargs: arguments of the function
+
+        Returns
+        -------
+        result of the function
+        """
+
+        if self._depth:  # already being recorded by an outer call
+            return func(*args, **kwargs)
+
+        before = _status_counts(rays)
+
+        self._depth += 1
+        t = time.perf_counter()
+
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t
+            self._depth -= 1
+
+        after = _status_counts(rays)
+        stopped = after - before
+
+        call = {'calls': 1, 'time': elapsed,
+                'rays_in': int(before[rt.ALIVE]),
+                'rays_out': int(after[rt.ALIVE]),
+                'vignetted': int(stopped[rt.VIGNETTED]),
+                'tir': int(stopped[rt.TIR]),
+                'missed': int(stopped[rt.MISSED])}
+
+        key = id(elem)
+
+        if key not in self._stats:
+            self._elems[key] = elem
+            self._stats[key] = dict.fromkeys(self.FIELDS, 0)
+
+        stats = self._stats[key]
+
+        for field in self.FIELDS:
+            stats[field] += call[field]
+
+        if self._callback is not None:
+            self._callback(elem, call)
+
+        return result
+
+    def report(self):
+        """
+        Method returns the statistics recorded for each element
+
+        Returns
+        -------
+        list of dictionaries of the FIELDS for each element, with the
+        element and a description of it, in the order first called
+        """
+
+        return [dict(self._stats[key], element=self._elems[key],
+                     label=_label(self._elems[key]))
+                for key in self._stats]
+
+    def reset(self):
+        """
+        Method forgets everything recorded so far
+        """
+
+        self._stats.clear()
+        self._elems.clear()
+
+    def __str__(self):
+
+        lines = ['%-30s %7s %10s %9s %9s %9s %9s %9s'
+                 % (('element',) + self.FIELDS)]
+
+        for row in self.report():
+            lines.append('%-30s %7d %10.4g %9d %9d %9d %9d %9d'
+                         % ((row['label'],) +
+                            tuple(row[field] for field in self.FIELDS)))
+
+        return '\n'.join(lines)
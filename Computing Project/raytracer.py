@@ -4,29 +4,178 @@ Emily Chini, 28/10/22
 Module to describe optical rays and bundles
 """
 
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 
+# termination status of a ray, set by the optical elements
+ALIVE = 0  # ray is still propagating
+VIGNETTED = 1  # ray fell outside the aperture of a surface
+TIR = 2  # ray underwent total internal reflection
+MISSED = 3  # ray has no real intersection with a surface
+TRUNCATED = 4  # ray was still bouncing when a non-sequential trace ended
+
+# most memory the remembered beam layouts may take up, in bytes
+LAYOUT_CACHE_BYTES = 64 * 2**20
+
+_layouts = OrderedDict()  # beam layouts, least recently used first
+_layout_bytes = 0
+
+
+def final_points(rays, with_ids=False):
+    """
+    Function that gathers the current points of the rays
+    that are still propagating, skipping any that were stopped
+
+    Parameters
+    ----------
+    rays: list of ray objects, or a RayBatch object
+
+    with_ids: if True, the IDs of the surviving rays are also returned
+
+    Returns
+    -------
+    (M, 3) array of the current point of each surviving ray
+
+    ids: only if with_ids is True, array of the ID of each surviving ray,
+         its position in the list or RayBatch.ids for a batch
+    """
+
+    if isinstance(rays, RayBatch):
+        alive = rays.alive()
+        points = rays.p()[alive]
+        ids = rays.ids()[alive]
+
+    else:
+        ids = np.array([i for i, ray in enumerate(rays) if ray.alive()],
+                       dtype=int)
+        points = np.array([rays[i].p() for i in ids],
+                          dtype=float).reshape(-1, 3)
+
+    if with_ids:
+        return points, ids
+
+    return points
+
+
+def circle_positions(r, n, start, stop):
+    """
+    Function that finds the x and y positions of a range of rays
+    in a beam made of concentric circles of evenly spaced rays,
+    numbering the rays circle by circle
+
+    Parameters
+    ----------
+    r : array of radi for each circle in the beam
+
+    n : array of numbers of evenly spaced rays in each circle
+
+    start, stop: range of ray numbers to find the positions of
+
+    Returns
+    -------
+    x: array of the x-coordinates of the rays
+
+    y: array of the y-coordinates of the rays
+    """
+
+    # number of the first ray in each circle of the beam
+    offsets = np.concatenate(([0], np.cumsum(n)))
+
+    index = np.arange(start, stop)
+    circle = np.searchsorted(offsets, index, side='right') - 1
+
+    theta = ((2 * np.pi) / n[circle]) * (index - offsets[circle])
+
+    return r[circle] * np.cos(theta), r[circle] * np.sin(theta)
+
+
+def clear_layout_cache():
+    """
+    Function that forgets every remembered beam layout
+    """
+
+    global _layout_bytes
+
+    _layouts.clear()
+    _layout_bytes = 0
+
+
+def _circle_layout(r, n):
+    """
+    Function that finds, and remembers, the positions of every ray
+    in a beam, so rebuilding the same bundle does not regenerate them,
+    forgetting the least recently used layouts once they take up more
+    than LAYOUT_CACHE_BYTES
+
+    Parameters
+    ----------
+    r : tuple of radi for each circle in the beam
+
+    n : tuple of numbers of evenly spaced rays in each circle
+
+    Returns
+    -------
+    x, y: read-only arrays of the x and y-coordinates of the rays
+    """
+
+    global _layout_bytes
+
+    key = (r, n)
+
+    if key in _layouts:
+        _layouts.move_to_end(key)
+        return _layouts[key]
+
+    x, y = circle_positions(np.array(r, dtype=float), np.array(n, dtype=int),
+                            0, sum(n))
+
+    x.flags.writeable = False
+    y.flags.writeable = False
+
+    size = x.nbytes + y.nbytes
+
+    if size <= LAYOUT_CACHE_BYTES:  # too big layouts are not remembered
+        _layouts[key] = x, y
+        _layout_bytes += size
+
+        while _layout_bytes > LAYOUT_CACHE_BYTES:
+            old_x, old_y = _layouts.popitem(last=False)[1]
+            _layout_bytes -= old_x.nbytes + old_y.nbytes
+
+    return x, y
+
 
 class Ray:
     """
     Class for an optical ray to be created
     """
 
-    def __init__(self, start_point=[0, 0, 0], start_direction=[0, 0, 0]):
+    def __init__(self, start_point=None, start_direction=None):
         """
         Parameters
         ----------
-        start_point: takes a defined 3D starting point from the user
+        start_point: takes a defined 3D starting point from the user,
+                     the origin by default
 
-        start_direction: takes a defined starting direction from the user
+        start_direction: takes a defined starting direction from the user,
+                         a zero vector by default
         """
 
-        self._start_point = np.array(start_point)
-        self._start_direction = np.array(start_direction)
+        if start_point is None:
+            start_point = np.zeros(3)
+
+        if start_direction is None:
+            start_direction = np.zeros(3)
+
+        self._start_point = np.array(start_point, dtype=float)
+        self._start_direction = np.array(start_direction, dtype=float)
         self._points = []  # running list of the points the ray hits
         self._directions = []  # running list of the ray's direction vectors
-        self._points.append(start_point)
-        self._directions.append(start_direction)
+        self._points.append(self._start_point)
+        self._directions.append(self._start_direction)
+        self._status = ALIVE
 
     def p(self):
         """
@@ -65,8 +214,45 @@ class Ray:
         k: 1D numpy array for new direction vector of the ray
         """
 
-        self._points.append(p)
-        self._directions.append(k)
+        self._points.append(np.asarray(p, dtype=float))
+        self._directions.append(np.asarray(k, dtype=float))
+
+        return self
+
+    def status(self):
+        """
+        Method returns the termination status of the ray
+
+        Returns
+        -------
+        one of ALIVE, VIGNETTED, TIR, MISSED or TRUNCATED
+        """
+
+        return self._status
+
+    def alive(self):
+        """
+        Method returns whether the ray is still propagating
+
+        Returns
+        -------
+        True if the ray has not been terminated
+        """
+
+        return self._status == ALIVE
+
+    def terminate(self, status):
+        """
+        Method stops the ray propagating any further
+
+        Parameters
+        ----------
+        status: reason the ray was stopped, one of VIGNETTED, TIR, MISSED
+                or TRUNCATED
+        """
+
+        if self._status == ALIVE:
+            self._status = status
 
         return self
 
@@ -127,37 +313,680 @@ class Bundle:
 
         Returns
         -------
-        self._x: list of the x-coordinates for the starting point of the rays
+        self._x: array of the x-coordinates for the starting point of the rays
+
+        self._y: array of the y-coordinates of the starting point of the rays
+        """
+
+        # layouts are remembered, so calling again gives the same arrays
+        self._x, self._y = _circle_layout(
+            tuple(float(r) for r in self._r), tuple(int(n) for n in self._n))
+
+        return self._x, self._y
+
+    def fingerprint(self):
+        """
+        Method to return a hash identifying the beam of rays,
+        so traces of the same beam can be recognised
+
+        Returns
+        -------
+        hexadecimal SHA-256 digest of the definition of the beam
+        """
+
+        digest = hashlib.sha256()
+
+        for values in (self._r, self._n, [self._z_value], self._initial_dir):
+            digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+            digest.update(b'|')
+
+        return digest.hexdigest()
+
+    def create_batch(self, history=True):
+        """
+        Method to create a single batch holding every ray in the beam
+
+        Parameters
+        ----------
+        history: if True, the batch keeps every vertex of the rays
 
-        self._y: list of the y-coordinates of the starting point of the rays
+        Returns
+        -------
+        batch : RayBatch object for the collimated beam,
+                with a starting point and starting direction for each ray
         """
 
-        for i in range(len(self._r)):
-            for j in range(self._n[i]):
+        x, y = self.positions()
+        n_rays = len(x)
 
-                theta = (2 * np.pi) / self._n[i]
+        points = np.empty((n_rays, 3))
+        points[:, 0] = x
+        points[:, 1] = y
+        points[:, 2] = self._z_value
 
-                self._x.append(self._r[i] * np.cos(j * theta))
-                self._y.append(self._r[i] * np.sin(j * theta))
+        directions = np.empty((n_rays, 3))
+        directions[:] = self._initial_dir
 
-        return self._x, self._y
+        return RayBatch(points, directions, history=history)
+
+    def iter_batches(self, chunk_size):
+        """
+        Method to generate the rays of the beam in fixed-size batches,
+        without keeping the positions of every ray in memory at once
+
+        Parameters
+        ----------
+        chunk_size: maximum number of rays in each batch
+
+        Yields
+        ------
+        batch: RayBatch object, without ray history,
+               for the next chunk of rays in the beam
+        """
+
+        n = np.asarray(self._n, dtype=int)
+        r = np.asarray(self._r, dtype=float)
+
+        n_rays = np.sum(n)
+
+        for start in range(0, n_rays, chunk_size):
+            stop = min(start + chunk_size, n_rays)
+
+            points = np.empty((stop - start, 3))
+            points[:, 0], points[:, 1] = circle_positions(r, n, start, stop)
+            points[:, 2] = self._z_value
+
+            directions = np.empty((stop - start, 3))
+            directions[:] = self._initial_dir
+
+            batch = RayBatch(points, directions, history=False)
+            batch._ids += start  # numbering the rays across the beam
 
-    def create_rays(self):
+            yield batch
+
+    def create_rays(self, n_surfaces=None):
         """
         Method to create lots of ray objects and adds them to a list
 
+        Parameters
+        ----------
+        n_surfaces: number of surfaces the rays will be traced through,
+                    if given the rays are RayView objects sharing a
+                    RayHistory with room for that many vertices per ray
+
         Returns
         -------
         rays : list of ray objects in the collimated beam,
                each with a starting point and starting direction
         """
 
+        if n_surfaces is not None:
+            batch = self.create_batch(history=False)
+            return RayHistory(batch.p(), batch.k(), n_surfaces).rays()
+
+        x, y = self.positions()
         rays = []
 
-        for i in range(len(self._x)):
+        for i in range(len(x)):
 
-            ray_i = Ray([self._x[i], self._y[i], self._z_value],
+            ray_i = Ray([x[i], y[i], self._z_value],
                         self._initial_dir)  # creating a bunch of ray objects
             rays.append(ray_i)
 
         return rays
+
+
+class RayBatch:
+    """
+    Class for a batch of optical rays stored as a structure of arrays,
+    so that a whole bundle can be stored and propagated at once
+    """
+
+    def __init__(self, start_points, start_directions, history=True):
+        """
+        Parameters
+        ----------
+        start_points: (N, 3) array of starting points, one row per ray
+
+        start_directions: (N, 3) array of starting direction vectors
+
+        history: if True, keeps every vertex of the rays so they can be
+                 plotted, otherwise only the current points are stored
+        """
+
+        self._points = np.array(start_points, dtype=float).reshape(-1, 3)
+        self._directions = np.array(
+            start_directions, dtype=float).reshape(-1, 3)
+
+        if len(self._points) != len(self._directions):
+            raise Exception('Number of points and directions do not match')
+
+        n_rays = len(self._points)
+
+        # termination status of each ray, ALIVE while still propagating
+        self._status = np.full(n_rays, ALIVE, dtype=np.int8)
+        self._opl = np.zeros(n_rays)  # optical path length of each ray
+        self._n = np.ones(n_rays)  # refractive index each ray travels in
+        self._ids = np.arange(n_rays)  # ID of each ray, kept by compact
+
+        self._history = None
+
+        if history:
+            # running lists of (N, 3) arrays, one per vertex of the rays
+            self._history = [self._points.copy()]
+            self._history_dirs = [self._directions.copy()]
+
+    def __len__(self):
+
+        return len(self._points)
+
+    @classmethod
+    def from_rays(cls, rays, history=True):
+        """
+        Method to gather the current points and directions
+        of a list of ray objects into a single batch
+
+        Parameters
+        ----------
+        rays: list of ray objects
+
+        history: if True, keeps every vertex of the rays
+
+        Returns
+        -------
+        batch: RayBatch object holding the rays
+        """
+
+        points = [ray.p() for ray in rays]
+        directions = [ray.k() for ray in rays]
+
+        batch = cls(points, directions, history=history)
+        batch._status[:] = [ray.status() for ray in rays]
+
+        return batch
+
+    def ids(self):
+        """
+        Method returns the ID of each ray, its position in the batch it was
+        first created in, which stays with the ray when batches are compacted
+
+        Returns
+        -------
+        array of the ID of each ray
+        """
+
+        return self._ids
+
+    def compact(self, mask=None):
+        """
+        Method gathers some of the rays into a new, densely packed batch,
+        by default those still propagating, so later surfaces do no work
+        on rays that were stopped
+
+        Parameters
+        ----------
+        mask: boolean array that is True for each ray to keep,
+              by default the rays that are still propagating
+
+        Returns
+        -------
+        batch: RayBatch object for the kept rays, with their IDs,
+               which does not keep the ray history
+        """
+
+        if mask is None:
+            mask = self.alive()
+
+        batch = RayBatch(self._points[mask], self._directions[mask],
+                         history=False)
+        batch._status[:] = self._status[mask]
+        batch._opl[:] = self._opl[mask]
+        batch._n[:] = self._n[mask]
+        batch._ids = self._ids[mask]
+
+        return batch
+
+    def p(self):
+        """
+        Method returns the current points of the rays
+
+        Returns
+        -------
+        (N, 3) array of the current point of each ray
+        """
+
+        return self._points
+
+    def k(self):
+        """
+        Method returns the current ray directions
+
+        Returns
+        -------
+        (N, 3) array of the current direction of each ray
+        """
+
+        return self._directions
+
+    def status(self):
+        """
+        Method returns the termination status of each ray
+
+        Returns
+        -------
+        array holding one of ALIVE, VIGNETTED, TIR, MISSED or TRUNCATED
+        for each ray
+        """
+
+        return self._status
+
+    def alive(self):
+        """
+        Method returns which rays are still propagating
+
+        Returns
+        -------
+        boolean array that is True for every ray still propagating
+        """
+
+        return self._status == ALIVE
+
+    def terminate(self, mask, status):
+        """
+        Method stops the selected rays propagating any further,
+        leaving rays that were already stopped unchanged
+
+        Parameters
+        ----------
+        mask: boolean array that is True for each ray to stop
+
+        status: reason the rays were stopped, either a single value or an
+                array with one value per ray in the batch
+        """
+
+        stopped = mask & (self._status == ALIVE)
+
+        if np.ndim(status) == 0:
+            self._status[stopped] = status
+        else:
+            self._status[stopped] = status[stopped]
+
+        return self
+
+    def opl(self):
+        """
+        Method returns the optical path length travelled by each ray
+
+        Returns
+        -------
+        array of the optical path length of each ray
+        """
+
+        return self._opl
+
+    def append(self, p, k, n=None):
+        """
+        Method appends a new point and direction to every ray in the batch,
+        adding the optical path length of the new segment
+
+        Parameters
+        ----------
+        p: (N, 3) array of new points the rays pass through
+
+        k: (N, 3) array of new direction vectors of the rays
+
+        n: refractive index of the medium the rays enter at p,
+           unchanged if None
+        """
+
+        segment = p - self._points
+        self._opl += self._n * np.sqrt(np.einsum('ij,ij->i',
+                                                 segment, segment))
+
+        self._points = np.asarray(p, dtype=float)
+        self._directions = np.asarray(k, dtype=float)
+
+        if n is not None:
+            self._n[:] = n
+
+        if self._history is not None:
+            self._history.append(self._points)
+            self._history_dirs.append(self._directions)
+
+        return self
+
+    def vertices(self):
+        """
+        Method to return all the points the rays have crossed
+
+        Returns
+        -------
+        (N, V, 3) array of the V vertices along each ray
+        """
+
+        if self._history is None:
+            raise Exception('Ray history is not being kept for this batch')
+
+        return np.stack(self._history, axis=1)
+
+    def rays(self):
+        """
+        Method to convert the batch into a list of ray objects,
+        so existing Ray-based scripts and plots keep working
+
+        Returns
+        -------
+        rays: list of RayView objects, one per ray in the batch,
+              sharing a single RayHistory of their vertices
+        """
+
+        return RayHistory.from_batch(self).rays()
+
+
+class RayHistory:
+    """
+    Class for the vertices of a bundle of rays stored in preallocated
+    (N, V, 3) arrays, with room for the vertices at a known number of
+    surfaces, which hands out lightweight RayView objects for the rays
+    """
+
+    def __init__(self, start_points, start_directions, n_surfaces):
+        """
+        Parameters
+        ----------
+        start_points: (N, 3) array of starting points, one row per ray
+
+        start_directions: (N, 3) array of starting direction vectors
+
+        n_surfaces: number of surfaces the rays will be traced through,
+                    the arrays are enlarged if a ray meets more
+        """
+
+        start_points = np.asarray(start_points, dtype=float).reshape(-1, 3)
+        start_directions = np.asarray(
+            start_directions, dtype=float).reshape(-1, 3)
+
+        if len(start_points) != len(start_directions):
+            raise Exception('Number of points and directions do not match')
+
+        shape = (len(start_points), n_surfaces + 1, 3)
+
+        # vertices not reached yet are nan, so plots leave them out
+        self._points = np.full(shape, np.nan)
+        self._directions = np.full(shape, np.nan)
+        self._points[:, 0] = start_points
+        self._directions[:, 0] = start_directions
+
+        self._count = np.ones(len(start_points), dtype=int)  # vertices
+        self._status = np.full(len(start_points), ALIVE, dtype=np.int8)
+
+    def __len__(self):
+
+        return len(self._points)
+
+    @classmethod
+    def from_batch(cls, batch):
+        """
+        Method to gather the vertices of every ray in a batch
+
+        Parameters
+        ----------
+        batch: RayBatch object, where only the current points of the rays
+               are gathered if it does not keep the ray history
+
+        Returns
+        -------
+        history: RayHistory object holding the rays
+        """
+
+        if batch._history is None:
+            points = batch.p()[:, np.newaxis]
+            directions = batch.k()[:, np.newaxis]
+        else:
+            points = np.stack(batch._history, axis=1)
+            directions = np.stack(batch._history_dirs, axis=1)
+
+        history = cls.__new__(cls)
+        history._points = points
+        history._directions = directions
+        history._count = np.full(len(batch), points.shape[1])
+        history._status = batch.status().copy()
+
+        return history
+
+    @staticmethod
+    def shared(rays):
+        """
+        Method finds whether every ray in a list is a view
+        into the same RayHistory, so they can be handled together
+
+        Parameters
+        ----------
+        rays: list of ray objects
+
+        Returns
+        -------
+        history: the RayHistory shared by the rays, None if there is none
+
+        rows: array of the row of each ray in the history
+        """
+
+        if len(rays) == 0 or not isinstance(rays[0], RayView):
+            return None, None
+
+        history = rays[0]._history
+
+        for ray in rays:
+            if not isinstance(ray, RayView) or ray._history is not history:
+                return None, None
+
+        return history, np.array([ray._index for ray in rays], dtype=int)
+
+    def gather(self, rows):
+        """
+        Method gathers the current points and directions of some of the
+        rays into a batch
+
+        Parameters
+        ----------
+        rows: array of the rows of the rays
+
+        Returns
+        -------
+        batch: RayBatch object, without ray history, holding the rays
+        """
+
+        last = self._count[rows] - 1
+
+        batch = RayBatch(self._points[rows, last],
+                         self._directions[rows, last], history=False)
+        batch._status[:] = self._status[rows]
+
+        return batch
+
+    def scatter(self, rows, batch):
+        """
+        Method records the result of propagating a gathered batch,
+        adding a vertex to each ray still propagating and stopping
+        the others, while rays stopped before are left unchanged
+
+        Parameters
+        ----------
+        rows: array of the rows of the rays, as given to gather
+
+        batch: the propagated RayBatch object
+        """
+
+        before = self._status[rows] == ALIVE
+        alive = before & batch.alive()
+        stopped = before & ~alive
+
+        rows_alive = rows[alive]
+
+        # each ray gains one vertex at most, so growing once is enough
+        if np.any(self._count[rows_alive] == self._points.shape[1]):
+            self._grow()
+
+        last = self._count[rows_alive]
+        self._points[rows_alive, last] = batch.p()[alive]
+        self._directions[rows_alive, last] = batch.k()[alive]
+        self._count[rows_alive] += 1
+
+        self._status[rows[stopped]] = batch.status()[stopped]
+
+    def rays(self):
+        """
+        Method returns a view of each ray, which can be used as
+        a ray object, storing its vertices in the shared arrays
+
+        Returns
+        -------
+        list of RayView objects, one per ray
+        """
+
+        return [RayView(self, i) for i in range(len(self))]
+
+    def vertices(self):
+        """
+        Method to return all the points the rays have crossed
+
+        Returns
+        -------
+        (N, V, 3) array of the vertices along each ray, which is nan
+        beyond the last vertex of a ray
+        """
+
+        return self._points
+
+    def _grow(self):
+        """
+        Method doubles the number of vertices the arrays have room for,
+        for rays meeting more surfaces than expected
+        """
+
+        n_rays, n_vertices = self._points.shape[:2]
+        extra = np.full((n_rays, n_vertices, 3), np.nan)
+
+        self._points = np.concatenate((self._points, extra), axis=1)
+        self._directions = np.concatenate((self._directions, extra), axis=1)
+
+
+class RayView:
+    """
+    Class for a single ray stored in a RayHistory, with the same methods
+    as the Ray class, whose vertices are views into the shared arrays
+    """
+
+    __slots__ = ('_history', '_index')
+
+    def __init__(self, history, index):
+        """
+        Parameters
+        ----------
+        history: RayHistory object the ray is stored in
+
+        index: row of the ray in the history
+        """
+
+        self._history = history
+        self._index = index
+
+    def p(self):
+        """
+        Method returns the current point of the ray
+
+        Returns
+        -------
+        current point as the last vertex of the ray
+        """
+
+        i = self._index
+
+        return self._history._points[i, self._history._count[i] - 1]
+
+    def k(self):
+        """
+        Method returns the current ray direction
+
+        Returns
+        -------
+        current direction as the last direction of the ray
+        """
+
+        i = self._index
+
+        return self._history._directions[i, self._history._count[i] - 1]
+
+    def append(self, p, k):
+        """
+        Method appends a new point and direction to the ray
+
+        Parameters
+        ----------
+        p: 1D numpy array for new point the ray passes through
+
+        k: 1D numpy array for new direction vector of the ray
+        """
+
+        history = self._history
+        i = self._index
+        j = history._count[i]
+
+        if j == history._points.shape[1]:
+            history._grow()
+
+        history._points[i, j] = p
+        history._directions[i, j] = k
+        history._count[i] = j + 1
+
+        return self
+
+    def status(self):
+        """
+        Method returns the termination status of the ray
+
+        Returns
+        -------
+        one of ALIVE, VIGNETTED, TIR, MISSED or TRUNCATED
+        """
+
+        return int(self._history._status[self._index])
+
+    def alive(self):
+        """
+        Method returns whether the ray is still propagating
+
+        Returns
+        -------
+        True if the ray has not been terminated
+        """
+
+        return self._history._status[self._index] == ALIVE
+
+    def terminate(self, status):
+        """
+        Method stops the ray propagating any further
+
+        Parameters
+        ----------
+        status: reason the ray was stopped, one of VIGNETTED, TIR, MISSED
+                or TRUNCATED
+        """
+
+        if self._history._status[self._index] == ALIVE:
+            self._history._status[self._index] = status
+
+        return self
+
+    def vertices(self):
+        """
+        Method to return all the points the ray has crossed
+
+        Returns
+        -------
+        (V, 3) array of the points along the ray, a view into the history
+        """
+
+        i = self._index
+
+        return self._history._points[i, :self._history._count[i]]
@@ -0,0 +1,365 @@
+"""
+rms_objective.py
+agent, 18/10/26
+Module for a fast RMS spot radius objective for optimising lens designs,
+which traces many candidate designs in a single vectorised call
+"""
+
+import numpy as np
+import optical_elements as oe
+import optical_system as osys
+
+
+# parameters of each refracting surface that an objective can vary
+PARAMETERS = ('curv', 'z0', 'n1', 'n2')
+
+
+class RmsObjective:
+    """
+    Class for the RMS spot radius of an optical system as a function of
+    parameters of its refracting surfaces (by default their curvatures),
+    tracing a bundle of rays that is only built once
+    """
+
+    def __init__(self, system, bundle, params=('curv',)):
+        """
+        Parameters
+        ----------
+        system: OpticalSystem object, whose refracting surfaces have their
+                parameters varied and whose last element is the output plane
+
+        bundle: Bundle object for the beam of rays traced for every design
+
+        params: names of the parameters varied for every refracting
+                surface, out of 'curv', 'z0' (z-coordinate of the vertex),
+                'n1' and 'n2'
+        """
+
+        for name in params:
+            if name not in PARAMETERS:
+                raise Exception('Unknown surface parameter %s' % name)
+
+        self._system = system
+
+        batch = bundle.create_batch()
+
+        self._p0 = batch.p()
+        self._k0 = oe.normalise(batch.k())
+
+        refracting = np.flatnonzero(system._kind == osys.REFRACTING)
+
+        # (surface, name) of each parameter of the objective
+        self._params = [(i, name) for i in refracting for name in params]
+
+        self.n_evals = 0  # number of designs traced so far
+
+    def n_params(self):
+        """
+        Method returns the number of parameters of the objective
+
+        Returns
+        -------
+        number of varied parameters over all refracting surfaces
+        """
+
+        return len(self._params)
+
+    def x0(self):
+        """
+        Method returns the parameters of the system as it was built
+
+        Returns
+        -------
+        array of the starting value of each parameter
+        """
+
+        return np.array([self._constants(i, name)
+                         for i, name in self._params])
+
+    def _constants(self, i, name):
+        """
+        Method returns a packed constant of a surface of the system
+
+        Parameters
+        ----------
+        i: index of the surface in the system
+
+        name: one of 'curv', 'z0', 'n1' or 'n2'
+
+        Returns
+        -------
+        value of the constant as built
+        """
+
+        sy = self._system
+
+        return {'curv': sy._curv, 'z0': sy._z0[:, 2],
+                'n1': sy._n1, 'n2': sy._n2}[name][i]
+
+    def _designs(self, designs):
+        """
+        Method swaps the parameters of each design into copies
+        of the packed constants of the system
+
+        Parameters
+        ----------
+        designs: (D, n_params) array of parameters for D designs
+
+        Returns
+        -------
+        dictionary of (D, n_surf) arrays for each surface constant
+        """
+
+        sy = self._system
+        n_designs = len(designs)
+
+        consts = {name: np.tile([self._constants(i, name)
+                                 for i in range(len(sy._kind))],
+                                (n_designs, 1))
+                  for name in PARAMETERS}
+
+        for j, (i, name) in enumerate(self._params):
+            consts[name][:, i] = designs[:, j]
+
+        return consts
+
+    def _seeds(self, i):
+        """
+        Method returns the derivative of each constant of a surface
+        with respect to every parameter of the objective
+
+        Parameters
+        ----------
+        i: index of the surface in the system
+
+        Returns
+        -------
+        dictionary of (n_params,) arrays for each surface constant
+        """
+
+        seeds = {name: np.zeros(len(self._params)) for name in PARAMETERS}
+
+        for j, (surf, name) in enumerate(self._params):
+            if surf == i:
+                seeds[name][j] = 1
+
+        return seeds
+
+    def evaluate(self, designs):
+        """
+        Method finds the RMS spot radius for many designs at once,
+        tracing the rays through every design as one (D, N, 3) array
+
+        Parameters
+        ----------
+        designs: array of parameters with shape (D, n_params) for D designs
+
+        Returns
+        -------
+        array of the RMS spot radius at the output plane for each design
+        """
+
+        designs = np.atleast_2d(np.asarray(designs, dtype=float))
+        n_designs = len(designs)
+
+        sy = self._system
+        consts = self._designs(designs)
+
+        p = np.broadcast_to(self._p0, (n_designs,) + self._p0.shape)
+        k = np.array(np.broadcast_to(self._k0, p.shape))
+        alive = np.ones(p.shape[:2], dtype=bool)
+        scratch = oe.SnellScratch()  # reused at every surface
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i in range(len(sy._kind)):
+
+                if sy._kind[i] != osys.REFRACTING:  # output plane or stop
+                    hit = sy.hit(p, k, i)
+                    alive &= hit.valid
+
+                else:
+                    z0 = np.tile(sy._z0[i], (n_designs, 1, 1))
+                    z0[:, 0, 2] = consts['z0'][:, i]
+
+                    hit = oe.sphere_hit(p, k, z0,
+                                        consts['curv'][:, i, np.newaxis],
+                                        sy._ap_rad_sq[i])
+                    mu = consts['n1'][:, i] / consts['n2'][:, i]
+                    k, tir = oe.snell_batch(k, hit.normal, mu[:, np.newaxis],
+                                            out=k, scratch=scratch)
+                    alive &= hit.valid & ~tir
+
+                p = hit.point
+
+        r_sq = np.where(alive, p[..., 0]**2 + p[..., 1]**2, 0)
+
+        self.n_evals += n_designs
+
+        return np.sqrt(np.sum(r_sq, axis=1) / np.sum(alive, axis=1))
+
+    def __call__(self, x):
+        """
+        Method finds the RMS spot radius for a single design
+
+        Parameters
+        ----------
+        x: array of parameters of the design
+
+        Returns
+        -------
+        RMS spot radius at the output plane
+        """
+
+        return self.evaluate(x)[0]
+
+    def value_and_grad(self, x):
+        """
+        Method finds the RMS spot radius and its gradient in a single
+        trace, carrying the derivatives of every ray's point and direction
+        with respect to each parameter along with the ray
+        (forward-mode differentiation)
+
+        Parameters
+        ----------
+        x: array of parameters of the design
+
+        Returns
+        -------
+        rms: RMS spot radius at the output plane
+
+        grad: array of the derivatives of the RMS spot radius
+              with respect to each parameter
+        """
+
+        x = np.asarray(x, dtype=float)
+
+        sy = self._system
+        consts = self._designs(x[np.newaxis])
+
+        e_z = np.array([0, 0, 1.0])
+
+        p = self._p0
+        k = self._k0.copy()
+        alive = np.ones(len(p), dtype=bool)
+
+        # derivatives of the points and directions, (n_params, N, 3)
+        dp = np.zeros((len(x),) + p.shape)
+        dk = np.zeros((len(x),) + p.shape)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i in range(len(sy._kind)):
+
+                if sy._kind[i] != osys.REFRACTING:  # output plane or stop
+                    hit = sy.hit(p, k, i)
+                    t = hit.distance
+                    alive &= hit.valid
+
+                    # the plane is fixed, so only the ray moves it
+                    dt = -(dp[..., 2] + t*dk[..., 2]) / k[:, 2]
+
+                    dp = dp + t[:, np.newaxis]*dk + dt[..., np.newaxis]*k
+                    p = hit.point
+                    continue
+
+                seeds = self._seeds(i)
+                curv = consts['curv'][0, i]
+                n1 = consts['n1'][0, i]
+                n2 = consts['n2'][0, i]
+
+                z0 = sy._z0[i].copy()
+                z0[2] = consts['z0'][0, i]
+
+                hit = oe.sphere_hit(p, k, z0, curv, sy._ap_rad_sq[i])
+                t = hit.distance
+                q = hit.point - z0
+
+                # differentiating the surface curv*|q|^2 - 2*q_z = 0
+                # at the intercept p + t*k
+                grad_f = 2*curv*q - 2*e_z
+                df_dcurv = oe._dot(q, q)
+                df_dz0 = 2 - 2*curv*q[:, 2]
+
+                dt = -(oe._dot(grad_f, dp + t[:, np.newaxis]*dk) +
+                       np.outer(seeds['curv'], df_dcurv) +
+                       np.outer(seeds['z0'], df_dz0)) / oe._dot(grad_f, k)
+
+                dq = (dp + t[:, np.newaxis]*dk + dt[..., np.newaxis]*k -
+                      seeds['z0'][:, np.newaxis, np.newaxis]*e_z)
+
+                # normal = -curv*q + e_z, facing along the rays
+                normal = hit.normal
+                dnormal = -(seeds['curv'][:, np.newaxis, np.newaxis]*q +
+                            curv*dq)
+
+                cos_1 = oe._dot(k, normal)
+                sign = np.where(cos_1 < 0, -1.0, 1.0)
+                normal = normal * sign[:, np.newaxis]
+                dnormal = dnormal * sign[:, np.newaxis]
+                cos_1 = cos_1 * sign
+
+                # differentiating Snell's law in 3D,
+                # k2 = mu*k + (cos_2 - mu*cos_1)*normal
+                mu = n1/n2
+                dmu = (seeds['n1']/n2 - (n1*seeds['n2'])/n2**2)[:, np.newaxis]
+
+                cos_2_sq = 1 - (mu**2)*(1 - cos_1**2)
+                tir = cos_2_sq < 0
+                cos_2 = np.sqrt(np.where(tir, 0, cos_2_sq))
+
+                dcos_1 = oe._dot(dk, normal) + oe._dot(k, dnormal)
+                dcos_2 = ((mu**2)*cos_1*dcos_1 - mu*dmu*(1 - cos_1**2)) / cos_2
+
+                coeff = cos_2 - mu*cos_1
+                dcoeff = dcos_2 - dmu*cos_1 - mu*dcos_1
+
+                dk = (dmu[..., np.newaxis]*k + mu*dk +
+                      dcoeff[..., np.newaxis]*normal +
+                      coeff[:, np.newaxis]*dnormal)
+                k = mu*k + coeff[:, np.newaxis]*normal
+
+                dp = dq + seeds['z0'][:, np.newaxis, np.newaxis]*e_z
+                p = hit.point
+
+                alive &= hit.valid & ~tir
+
+        n_alive = np.sum(alive)
+
+        r_sq = np.where(alive, p[:, 0]**2 + p[:, 1]**2, 0)
+        rms = np.sqrt(np.sum(r_sq) / n_alive)
+
+        # d(rms) = sum(x*dx + y*dy) / (n*rms)
+        dr = np.where(alive, p[:, 0]*dp[..., 0] + p[:, 1]*dp[..., 1], 0)
+        grad = np.sum(dr, axis=1) / (n_alive * rms)
+
+        self.n_evals += 1
+
+        return rms, grad
+
+    def finite_difference_grad(self, x, step=1e-6):
+        """
+        Method finds the RMS spot radius and its gradient using central
+        differences, with every shifted design traced together in one call
+
+        Parameters
+        ----------
+        x: array of parameters of the design
+
+        step: change in each parameter used for the central differences
+
+        Returns
+        -------
+        rms: RMS spot radius at the output plane
+
+        grad: array of the derivatives of the RMS spot radius
+              with respect to each parameter
+        """
+
+        x = np.asarray(x, dtype=float)
+        shifts = step * np.eye(len(x))
+
+        rms = self.evaluate(np.vstack((x, x + shifts, x - shifts)))
+
+        n = len(x)
+        grad = (rms[1:n+1] - rms[n+1:]) / (2 * step)
+
+        return rms[0], grad
@@ -0,0 +1,199 @@
+"""
+sharded_trace.py
+agent, 18/10/26
+Module to trace very large batches of rays on several cores,
+splitting the batch into chunks held in shared memory
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import raytracer as rt
+
+
+def _shared_array(shape, dtype):
+    """
+    Function that allocates an array in a new block of shared memory
+
+    Parameters
+    ----------
+    shape: shape of the array
+
+    dtype: data type of the array
+
+    Returns
+    -------
+    shm: the SharedMemory block, which must be unlinked once finished with
+
+    array: numpy array backed by the block
+    """
+
+    size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach(spec):
+    """
+    Function that attaches to the shared memory blocks of a sharded batch
+    from inside a worker process
+
+    Parameters
+    ----------
+    spec: dictionary of (name, shape, dtype) for each shared array
+
+    Returns
+    -------
+    blocks: list of the attached SharedMemory blocks
+
+    arrays: dictionary of numpy arrays backed by the blocks
+    """
+
+    blocks = []
+    arrays = {}
+
+    for key, (name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    return blocks, arrays
+
+
+def _trace_chunk(elems, spec, start, stop):
+    """
+    Function run in a worker process to trace one chunk of a batch,
+    reading the rays from and writing them back to shared memory
+
+    Parameters
+    ----------
+    elems: OpticalSystem object, or list of optical elements
+
+    spec: dictionary of (name, shape, dtype) for each shared array
+
+    start, stop: range of rays in the batch making up the chunk
+    """
+
+    blocks, arrays = _attach(spec)
+
+    try:
+        history = 'history' in arrays
+
+        chunk = rt.RayBatch(arrays['points'][start:stop],
+                            arrays['directions'][start:stop], history=history)
+        chunk._status[:] = arrays['status'][start:stop]
+        chunk._opl[:] = arrays['opl'][start:stop]
+        chunk._n[:] = arrays['n'][start:stop]
+
+        if isinstance(elems, list):
+            for elem in elems:
+                elem.propagate_rays(chunk)
+        else:
+            elems.trace(chunk)
+
+        arrays['points'][start:stop] = chunk.p()
+        arrays['directions'][start:stop] = chunk.k()
+        arrays['status'][start:stop] = chunk.status()
+        arrays['opl'][start:stop] = chunk.opl()
+        arrays['n'][start:stop] = chunk._n
+
+        if history:
+            arrays['history'][start:stop] = chunk.vertices()[:, 1:]
+            arrays['history_dirs'][start:stop] = np.stack(
+                chunk._history_dirs[1:], axis=1)
+
+    finally:
+        for shm in blocks:
+            shm.close()
+
+    return stop - start
+
+
+def trace_sharded(elems, batch, workers, chunk_size=None):
+    """
+    Function that traces a batch of rays through optical elements
+    using a pool of worker processes, giving the same result as tracing
+    the whole batch in a single process
+
+    Parameters
+    ----------
+    elems: OpticalSystem object, or list of optical elements
+
+    batch: object of the RayBatch class, updated in place
+
+    workers: number of worker processes to use
+
+    chunk_size: number of rays in each chunk, by default the batch is
+                split into four chunks per worker to balance the load
+
+    Returns
+    -------
+    batch: the propagated batch of rays
+    """
+
+    n_rays = len(batch)
+    n_surf = len(elems)  # number of surfaces the rays pass through
+
+    if chunk_size is None:
+        chunk_size = -(-n_rays // (4 * workers))
+
+    chunk_size = max(chunk_size, 1)
+
+    history = batch._history is not None
+
+    shapes = {'points': ((n_rays, 3), np.float64),
+              'directions': ((n_rays, 3), np.float64),
+              'status': ((n_rays,), np.int8),
+              'opl': ((n_rays,), np.float64),
+              'n': ((n_rays,), np.float64)}
+
+    if history:
+        shapes['history'] = ((n_rays, n_surf, 3), np.float64)
+        shapes['history_dirs'] = ((n_rays, n_surf, 3), np.float64)
+
+    blocks = []
+    arrays = {}
+    spec = {}
+
+    try:
+        for key, (shape, dtype) in shapes.items():
+            shm, arrays[key] = _shared_array(shape, dtype)
+            blocks.append(shm)
+            spec[key] = (shm.name, shape, dtype)
+
+        arrays['points'][:] = batch.p()
+        arrays['directions'][:] = batch.k()
+        arrays['status'][:] = batch.status()
+        arrays['opl'][:] = batch.opl()
+        arrays['n'][:] = batch._n
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_trace_chunk, elems, spec, start,
+                                   min(start + chunk_size, n_rays))
+                       for start in range(0, n_rays, chunk_size)]
+
+            for future in futures:
+                future.result()  # raises any error from the workers
+
+        # merging the chunks back into the batch
+        batch._points = arrays['points'].copy()
+        batch._directions = arrays['directions'].copy()
+        batch._status[:] = arrays['status']
+        batch._opl[:] = arrays['opl']
+        batch._n[:] = arrays['n']
+
+        if history:
+            for i in range(n_surf):
+                batch._history.append(arrays['history'][:, i].copy())
+                batch._history_dirs.append(
+                    arrays['history_dirs'][:, i].copy())
+
+    finally:
+        arrays.clear()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return batch
@@ -0,0 +1,205 @@
+"""
+spot_statistics.py
+agent, 18/10/26
+Module to accumulate spot diagram statistics, such as the RMS spot radius,
+from batches of rays in a single pass
+"""
+
+import numpy as np
+import raytracer as rt
+
+
+class SpotStatistics:
+    """
+    Class for running statistics of the points where rays meet an
+    output plane, which can be fed batches of rays one at a time
+    and merged with statistics from other traces
+    """
+
+    def __init__(self, r_max=None, n_bins=100):
+        """
+        Parameters
+        ----------
+        r_max: largest radius from the optical axis binned for the
+               encircled energy, no histogram is kept if None
+
+        n_bins: number of radial bins for the encircled energy
+        """
+
+        self._count = 0
+        self._mean = np.zeros(2)  # centroid of the spot
+        self._m2 = np.zeros(2)  # sums of squared deviations from centroid
+        self._max_radius = 0.0
+
+        self._bin_edges = None
+        self._hist = None
+
+        if r_max is not None:
+            self._bin_edges = np.linspace(0, r_max, n_bins + 1)
+            self._hist = np.zeros(n_bins, dtype=np.int64)
+
+    def add(self, rays):
+        """
+        Method adds the points of a batch of rays to the statistics,
+        skipping rays that are no longer propagating
+
+        Parameters
+        ----------
+        rays: RayBatch object, list of ray objects,
+              or (M, 2) or (M, 3) array of points in the output plane
+
+        Returns
+        -------
+        self, so calls can be chained
+        """
+
+        if isinstance(rays, np.ndarray):
+            xy = rays[:, :2]
+        else:
+            xy = rt.final_points(rays)[:, :2]
+
+        n_b = len(xy)
+
+        if n_b == 0:
+            return self
+
+        mean_b = xy.mean(axis=0)
+        m2_b = np.sum((xy - mean_b)**2, axis=0)
+
+        self._combine(n_b, mean_b, m2_b)
+
+        r_sq = np.einsum('ij,ij->i', xy, xy)
+        self._max_radius = max(self._max_radius, np.sqrt(r_sq.max()))
+
+        if self._hist is not None:
+            self._hist += np.histogram(np.sqrt(r_sq),
+                                       bins=self._bin_edges)[0]
+
+        return self
+
+    def _combine(self, n_b, mean_b, m2_b):
+        """
+        Method updates the count, centroid and sums of squared deviations
+        with those of another set of points, using the pairwise form of
+        Welford's algorithm to stay numerically stable
+
+        Parameters
+        ----------
+        n_b: number of points in the other set
+
+        mean_b: centroid of the other set
+
+        m2_b: sums of squared deviations of the other set from its centroid
+        """
+
+        n_a = self._count
+        n = n_a + n_b
+
+        delta = mean_b - self._mean
+
+        self._mean = self._mean + delta * (n_b / n)
+        self._m2 = self._m2 + m2_b + (delta**2) * (n_a * n_b / n)
+        self._count = n
+
+    def merge(self, other):
+        """
+        Method merges the statistics of another accumulator,
+        such as one from a different shard of the same trace
+
+        Parameters
+        ----------
+        other: SpotStatistics object with the same histogram bins
+
+        Returns
+        -------
+        self, so calls can be chained
+        """
+
+        if other._count == 0:
+            return self
+
+        self._combine(other._count, other._mean, other._m2)
+        self._max_radius = max(self._max_radius, other._max_radius)
+
+        if self._hist is not None:
+            if (other._hist is None or
+                    not np.array_equal(self._bin_edges, other._bin_edges)):
+                raise Exception('Histogram bins do not match')
+
+            self._hist += other._hist
+
+        return self
+
+    def count(self):
+        """
+        Method returns the number of rays added
+
+        Returns
+        -------
+        number of surviving rays in the statistics
+        """
+
+        return self._count
+
+    def centroid(self):
+        """
+        Method returns the centroid of the spot
+
+        Returns
+        -------
+        array of the mean x and y coordinates
+        """
+
+        return self._mean.copy()
+
+    def rms(self):
+        """
+        Method returns the RMS spot radius about the optical axis,
+        as calculated by plot.rms
+
+        Returns
+        -------
+        RMS distance of the rays from the optical axis
+        """
+
+        return np.sqrt((np.sum(self._m2) / self._count) +
+                       np.dot(self._mean, self._mean))
+
+    def rms_centroid(self):
+        """
+        Method returns the RMS spot radius about the centroid of the spot
+
+        Returns
+        -------
+        RMS distance of the rays from the centroid
+        """
+
+        return np.sqrt(np.sum(self._m2) / self._count)
+
+    def max_radius(self):
+        """
+        Method returns the largest distance of a ray from the optical axis
+
+        Returns
+        -------
+        maximum radius of the spot
+        """
+
+        return self._max_radius
+
+    def encircled_energy(self):
+        """
+        Method returns the fraction of rays within each radius of the
+        optical axis, using the histogram bins
+
+        Returns
+        -------
+        radii: outer edge of each radial bin
+
+        fraction: fraction of the rays falling within each radius
+        """
+
+        if self._hist is None:
+            raise Exception('No histogram is kept, set r_max to bin radii')
+
+        return self._bin_edges[1:], np.cumsum(self._hist) / self._count
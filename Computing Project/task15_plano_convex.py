@@ -9,6 +9,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 import raytracer as rt
 import optical_elements as oe
+import optical_system as osys
+import paraxial as px
+import focus as fc
 import plot as pt
 # %%
 # for the case where the plane surface faces the input
@@ -36,10 +39,18 @@ for ray in rays:
 pf = conv_surf.paraxial_focus(testray)
 print('Plane surface faces the input')
 print('Paraxial focus at z =', pf)
+print('Paraxial focus from system matrix at z =',
+      px.ParaxialSystem(elems).focus())
+
+# plane with the smallest RMS spot radius for a 10 mm beam
+bundle = rt.Bundle(np.linspace(0, 5, 5), [1, 10, 25, 50, 100], 0, [0, 0, 1])
+print('Best focus at z = %.4f, RMS = %.6f'
+      % fc.best_focus(elems, bundle.create_batch()))
 plt.show()
 
 # moving output plane to paraxial focus
 output_plane.redefine_z(pf)
+system = osys.OpticalSystem(elems)
 
 # for a range of beam diameters up to 10 mm
 radius = [1, 2.5, 5]
@@ -50,13 +61,11 @@ for i in range(len(radius)):
 
     x, y = bundle.positions()
     pt.plot_positions(x, y)
-    rays = bundle.create_rays()
+    rays = bundle.create_rays(len(elems))
 
-    for elem in elems:
-        elem.propagate_rays(rays)
+    system.trace(rays)
 
-    for ray in rays:
-        pt.plot_ray(ray)
+    pt.plot_rays(rays)
 
     d = radius[i]*2
 
@@ -94,10 +103,18 @@ for ray in rays:
 pf = conv_surf.paraxial_focus(testray)
 print('\nConvex surface faces the input')
 print('Paraxial focus at z =', pf)
+print('Paraxial focus from system matrix at z =',
+      px.ParaxialSystem(elems).focus())
+
+# plane with the smallest RMS spot radius for a 10 mm beam
+bundle = rt.Bundle(np.linspace(0, 5, 5), [1, 10, 25, 50, 100], 0, [0, 0, 1])
+print('Best focus at z = %.4f, RMS = %.6f'
+      % fc.best_focus(elems, bundle.create_batch()))
 plt.show()
 
 # moving output plane to paraxial focus
 output_plane.redefine_z(pf)
+system = osys.OpticalSystem(elems)
 
 # for a range of beam diameters up to 10 mm
 radius = [1, 2.5, 5]
@@ -108,13 +125,11 @@ for i in range(len(radius)):
 
     x, y = bundle.positions()
     pt.plot_positions(x, y)
-    rays = bundle.create_rays()
+    rays = bundle.create_rays(len(elems))
 
-    for elem in elems:
-        elem.propagate_rays(rays)
+    system.trace(rays)
 
-    for ray in rays:
-        pt.plot_ray(ray)
+    pt.plot_rays(rays)
 
     d = radius[i]*2
 
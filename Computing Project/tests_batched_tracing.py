@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+tests_batched_tracing.py
+agent, 18/10/26
+Code to check that the faster ways of tracing batches of rays give the
+same results as the straightforward ones, stopping with an error if not
+"""
+import numpy as np
+import raytracer as rt
+import optical_elements as oe
+import optical_system as osys
+import rms_objective as ro
+import nonsequential as ns
+import bvh
+
+
+def make_lens():
+    """
+    Function for a biconvex singlet, with a stop that vignettes the edge
+    of the beam and an output plane near the paraxial focus
+
+    Returns
+    -------
+    list of optical elements
+    """
+
+    return [oe.SphericalRefraction(z0=[0, 0, 100], curv=0.02, n1=1,
+                                   n2=1.5168, ap_rad=100),
+            oe.Stop(z=103, ap_rad=3),
+            oe.SphericalRefraction(z0=[0, 0, 105], curv=-0.02, n1=1.5168,
+                                   n2=1, ap_rad=100),
+            oe.OutputPlane(z=198.45)]
+
+
+def assert_same(a, b, alive_n=False):
+    """
+    Function that checks two traced batches of rays are bitwise equal
+
+    Parameters
+    ----------
+    a, b: RayBatch objects
+
+    alive_n: if True, the refractive index is only compared for the rays
+             still propagating, since it is not updated for stopped rays
+             that were compacted away
+    """
+
+    assert np.array_equal(a.status(), b.status())
+    assert np.array_equal(a.p(), b.p(), equal_nan=True)
+    assert np.array_equal(a.k(), b.k(), equal_nan=True)
+    assert np.array_equal(a.opl(), b.opl(), equal_nan=True)
+
+    if alive_n:
+        assert np.array_equal(a._n[a.alive()], b._n[b.alive()])
+    else:
+        assert np.array_equal(a._n, b._n)
+
+    if a._history is not None:
+        assert np.array_equal(a.vertices(), b.vertices(), equal_nan=True)
+        assert np.array_equal(np.stack(a._history_dirs, axis=1),
+                              np.stack(b._history_dirs, axis=1),
+                              equal_nan=True)
+
+
+if __name__ == '__main__':  # the sharded trace starts worker processes
+
+    bundle = rt.Bundle(np.linspace(0, 5, 20), np.arange(20)*6 + 1, 0,
+                       [0.05, 0, 1])
+
+    # %%
+    # forward-mode gradients against central differences,
+    # for every parameter of both refracting surfaces
+
+    system = osys.OpticalSystem(make_lens())
+    objective = ro.RmsObjective(system, bundle,
+                                params=('curv', 'z0', 'n1', 'n2'))
+    x = objective.x0()
+
+    rms, grad = objective.value_and_grad(x)
+    rms_fd, grad_fd = objective.finite_difference_grad(x)
+
+    print('RMS:', rms, 'gradient:', grad)
+    print('largest difference from central differences:',
+          np.max(np.abs(grad - grad_fd)))
+
+    assert np.isclose(rms, rms_fd, rtol=1e-12)
+    assert np.allclose(grad, grad_fd, rtol=1e-5, atol=1e-7)
+
+    # %%
+    # tracing on several worker processes against a single process,
+    # with and without the ray history
+
+    for history in (True, False):
+        serial = bundle.create_batch(history=history)
+        osys.OpticalSystem(make_lens()).trace(serial)
+
+        sharded = bundle.create_batch(history=history)
+        osys.OpticalSystem(make_lens()).trace(sharded, workers=2)
+
+        assert_same(serial, sharded)
+
+    print('sharded traces match the serial trace')
+
+    # %%
+    # compacting the rays still propagating against tracing every ray,
+    # where the stop leaves few enough rays for compaction to happen
+
+    for history in (True, False):
+        full = bundle.create_batch(history=history)
+        osys.OpticalSystem(make_lens()).trace(full, compact=0)
+
+        compacted = bundle.create_batch(history=history)
+        osys.OpticalSystem(make_lens()).trace(compacted, compact=0.7)
+
+        assert np.count_nonzero(full.alive()) < 0.7 * len(full)
+        assert_same(full, compacted, alive_n=True)
+
+    print('compacted traces match the full trace')
+
+    # %%
+    # rays almost perpendicular to the axis meeting a convex and a concave
+    # surface, against the intercepts found by hand, for a single ray and
+    # for a batch
+
+    for curv, z, x in ((0.05, 2, -np.sqrt(76)), (-0.05, -2, np.sqrt(76))):
+        surface = oe.SphericalRefraction(z0=[0, 0, 0], curv=curv, ap_rad=100)
+        p = np.array([-30, 0, z], dtype=float)
+        k = np.array([1, 0, 1e-9])
+
+        single = surface.hit(rt.Ray(p, k))
+        batch = surface.hit(rt.RayBatch(p[np.newaxis], k[np.newaxis]))
+
+        assert single.status == rt.ALIVE and batch.status[0] == rt.ALIVE
+        assert np.allclose(single.point, [x, 0, z], rtol=0, atol=1e-6)
+        assert np.allclose(batch.point[0], single.point, rtol=1e-12)
+
+    print('grazing rays meet the surfaces where expected')
+
+    # %%
+    # an element that only defines propagate_ray still propagates a list
+
+    class Shift(oe.OpticalElement):
+
+        def propagate_ray(self, ray):
+            ray.append(ray.p() + [1, 0, 0], ray.k())
+
+    rays = bundle.create_rays()
+    Shift().propagate_rays(rays)
+
+    assert all(np.array_equal(ray.p(), ray.vertices()[0] + [1, 0, 0])
+               for ray in rays)
+
+    print('elements without propagate_batch propagate lists ray by ray')
+
+    # %%
+    # a list of rays is not silently traced in this process when asked
+    # to split it between workers
+
+    for trace in (osys.OpticalSystem(make_lens()).trace,
+                  make_lens()[0].propagate_rays):
+        try:
+            trace(bundle.create_rays(), workers=2)
+        except Exception:
+            continue
+
+        raise AssertionError('list of rays traced with workers')
+
+    print('lists of rays are not split between workers')
+
+    # %%
+    # the non-sequential trace through a lens the rays cross in order,
+    # against the sequential trace, where they differ only by rounding
+
+    serial = osys.OpticalSystem(make_lens()).trace(bundle.create_batch())
+    bounced, order = ns.trace_nonsequential(make_lens(),
+                                            bundle.create_batch())
+    alive = serial.alive()
+
+    assert np.array_equal(serial.status(), bounced.status())
+    assert np.all(order[alive] == [0, 1, 2, 3])
+    assert np.all(order[~alive] == [0, 1, -1, -1])
+
+    for a, b in ((serial.p(), bounced.p()), (serial.k(), bounced.k()),
+                 (serial.opl(), bounced.opl()),
+                 (serial.vertices(), bounced.vertices())):
+        assert np.allclose(a[alive], b[alive], rtol=1e-12, atol=1e-12)
+
+    print('non-sequential trace matches the sequential trace')
+
+    # %%
+    # nearest surfaces found through the bounding volume hierarchy against
+    # testing every surface, for rays starting all around the lens in
+    # random directions, a quarter of them almost perpendicular to the axis
+
+    system = osys.OpticalSystem(make_lens())
+    rng = np.random.default_rng(0)
+    n_rays = 2000
+
+    p = np.column_stack((rng.uniform(-20, 20, n_rays),
+                         rng.uniform(-20, 20, n_rays),
+                         rng.uniform(0, 250, n_rays)))
+    k = rng.normal(size=(n_rays, 3))
+    k[:n_rays // 4, 2] *= 1e-6
+    k = oe.normalise(k)
+
+    surface, hit = bvh.SurfaceBVH(system).nearest_hit(p, k)
+    surface_all, hit_all = bvh.nearest_hit(system, p, k,
+                                           bvh.all_candidates(system, n_rays))
+
+    assert np.array_equal(surface, surface_all)
+    assert np.array_equal(hit.status, hit_all.status)
+    assert np.array_equal(hit.point, hit_all.point, equal_nan=True)
+    assert np.array_equal(hit.distance, hit_all.distance, equal_nan=True)
+
+    print('bounding volume hierarchy finds the same surfaces as testing '
+          'every one')
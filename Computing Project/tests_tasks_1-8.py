@@ -149,7 +149,7 @@ rays = [ray10, ray11, ray12]
 
 zero_curv_surf = oe.SphericalRefraction(
     z0=[0, 0, 3], curv=0, n1=1, n2=1.5, ap_rad=10)
-# to raise exception of no intercept, change ap_rad to 0.25
+# to stop rays missing the aperture (vignetting), change ap_rad to 0.25
 
 output_plane = oe.OutputPlane(z=40)
 
@@ -9,6 +9,7 @@ using a beam of rays
 import matplotlib.pyplot as plt
 import raytracer as rt
 import optical_elements as oe
+import optical_system as osys
 import plot as pt
 
 conv_surf = oe.SphericalRefraction(
@@ -39,15 +40,14 @@ bundle = rt.Bundle([0, 1, 2.5, 5], [1, 10, 25, 50], 0, [0, 0, 1])
 x, y = bundle.positions()
 pt.plot_positions(x, y)
 
-rays = bundle.create_rays()
+rays = bundle.create_rays(len(elems))
 
 # propagating rays
-for elem in elems:
-    elem.propagate_rays(rays)
+system = osys.OpticalSystem(elems)
+system.trace(rays)
 
 # plotting rays
-for ray in rays:
-    pt.plot_ray(ray)
+pt.plot_rays(rays)
 plt.title('Task 12: Tracing a large diameter uniform bundle \nof collimated'
           ' rays through a convex lens')
 plt.show()
@@ -0,0 +1,333 @@
+"""
+trace_cache.py
+agent, 18/10/26
+Module to cache the results of tracing bundles of rays through optical
+systems, keyed by a fingerprint of the system and the bundle
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import raytracer as rt
+
+
+def _nbytes(batch):
+    """
+    Function that finds the memory held by the arrays of a batch of rays
+
+    Parameters
+    ----------
+    batch: object of the RayBatch class
+
+    Returns
+    -------
+    number of bytes held by the batch
+    """
+
+    arrays = [batch._points, batch._directions, batch._status, batch._opl,
+              batch._n]
+
+    if batch._history is not None:
+        arrays += batch._history + batch._history_dirs
+
+    return sum(a.nbytes for a in arrays)
+
+
+def _checkout(batch):
+    """
+    Function that hands out a cached batch of rays, sharing its point and
+    direction arrays (which are read-only) but copying the per-ray arrays
+    that further propagation updates in place
+
+    Parameters
+    ----------
+    batch: object of the RayBatch class held in the cache
+
+    Returns
+    -------
+    new RayBatch object for the same rays
+    """
+
+    copy = rt.RayBatch.__new__(rt.RayBatch)
+    copy.__dict__.update(batch.__dict__)
+
+    copy._status = batch._status.copy()
+    copy._opl = batch._opl.copy()
+    copy._n = batch._n.copy()
+
+    if batch._history is not None:
+        copy._history = list(batch._history)
+        copy._history_dirs = list(batch._history_dirs)
+
+    return copy
+
+
+def _freeze(batch):
+    """
+    Function that makes the shared arrays of a cached batch read-only
+
+    Parameters
+    ----------
+    batch: object of the RayBatch class to be held in the cache
+    """
+
+    arrays = [batch._points, batch._directions]
+
+    if batch._history is not None:
+        arrays += batch._history + batch._history_dirs
+
+    for a in arrays:
+        a.flags.writeable = False
+
+
+class TraceCache:
+    """
+    Class for a least-recently-used cache of traced bundles of rays,
+    kept within a memory budget, with an optional tier of files on disk
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, directory=None):
+        """
+        Parameters
+        ----------
+        max_bytes: most memory the cached rays may take up, in bytes
+
+        directory: folder to also keep every traced bundle in,
+                   so they outlive the process, or None to keep none
+        """
+
+        self._max_bytes = max_bytes
+        self._directory = directory
+
+        self._entries = OrderedDict()  # least recently used first
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def nbytes(self):
+        """
+        Method returns the memory taken up by the cached rays
+
+        Returns
+        -------
+        number of bytes held in memory
+        """
+
+        return self._bytes
+
+    @staticmethod
+    def key(system, bundle, history=False):
+        """
+        Method returns the key a trace is cached under
+
+        Parameters
+        ----------
+        system: OpticalSystem object the rays are traced through
+
+        bundle: Bundle object for the beam of rays
+
+        history: whether every vertex of the rays is kept
+
+        Returns
+        -------
+        hexadecimal digest combining the fingerprints of the system and
+        the bundle
+        """
+
+        digest = hashlib.sha256()
+        digest.update(system.fingerprint().encode())
+        digest.update(bundle.fingerprint().encode())
+        digest.update(b'history' if history else b'final')
+
+        return digest.hexdigest()
+
+    def trace(self, system, bundle, history=False):
+        """
+        Method returns the bundle of rays traced through the system,
+        only tracing it if the same configuration is not cached
+
+        Parameters
+        ----------
+        system: OpticalSystem object the rays are traced through
+
+        bundle: Bundle object for the beam of rays
+
+        history: whether every vertex of the rays is kept
+
+        Returns
+        -------
+        batch: RayBatch object for the traced rays
+        """
+
+        key = self.key(system, bundle, history)
+
+        batch = self.get(key)
+
+        if batch is None:
+            batch = system.trace(bundle.create_batch(history=history))
+
+            self.put(key, batch)
+
+            if key in self._entries:
+                batch = self.get(key, count=False)
+
+        return batch
+
+    def get(self, key, count=True):
+        """
+        Method returns a cached trace, looking in memory then on disk
+
+        Parameters
+        ----------
+        key: key the trace is cached under
+
+        count: whether to count the look-up as a hit or a miss
+
+        Returns
+        -------
+        batch: RayBatch object for the traced rays, None if not cached
+        """
+
+        batch = self._entries.get(key)
+
+        if batch is None and self._directory is not None:
+            batch = self._load(key)
+
+            if batch is not None:
+                self._remember(key, batch)
+
+        if batch is None:
+            self.misses += count
+            return None
+
+        if key in self._entries:
+            self._entries.move_to_end(key, last=True)
+
+        self.hits += count
+
+        return _checkout(batch)
+
+    def put(self, key, batch):
+        """
+        Method caches a trace in memory and, if kept, on disk
+
+        Parameters
+        ----------
+        key: key to cache the trace under
+
+        batch: RayBatch object for the traced rays, which is
+               taken over by the cache and must not be changed
+        """
+
+        if key in self._entries:
+            return
+
+        _freeze(batch)
+
+        if self._directory is not None:
+            self._save(key, batch)
+
+        self._remember(key, batch)
+
+    def clear(self):
+        """
+        Method empties the memory tier of the cache
+        """
+
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remember(self, key, batch):
+        """
+        Method keeps a trace in memory, dropping the least recently
+        used traces until the cache is within its memory budget
+
+        Parameters
+        ----------
+        key: key to cache the trace under
+
+        batch: RayBatch object for the traced rays
+        """
+
+        size = _nbytes(batch)
+
+        if size > self._max_bytes:  # too large to ever keep in memory
+            return
+
+        self._entries[key] = batch
+        self._bytes += size
+
+        while self._bytes > self._max_bytes:
+            old_key, old_batch = self._entries.popitem(last=False)
+            self._bytes -= _nbytes(old_batch)
+
+    def _path(self, key):
+
+        return os.path.join(self._directory, key + '.npz')
+
+    def _save(self, key, batch):
+        """
+        Method writes a trace to the disk tier
+
+        Parameters
+        ----------
+        key: key to cache the trace under
+
+        batch: RayBatch object for the traced rays
+        """
+
+        arrays = {'points': batch._points, 'directions': batch._directions,
+                  'status': batch._status, 'opl': batch._opl, 'n': batch._n}
+
+        if batch._history is not None:
+            arrays['history'] = np.stack(batch._history)
+            arrays['history_dirs'] = np.stack(batch._history_dirs)
+
+        # writing to a new file first so an interruption cannot corrupt it
+        with open(self._path(key) + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+
+        os.replace(self._path(key) + '.tmp', self._path(key))
+
+    def _load(self, key):
+        """
+        Method reads a trace from the disk tier
+
+        Parameters
+        ----------
+        key: key the trace is cached under
+
+        Returns
+        -------
+        batch: RayBatch object for the traced rays, None if not on disk
+        """
+
+        if not os.path.exists(self._path(key)):
+            return None
+
+        with np.load(self._path(key)) as arrays:
+            history = 'history' in arrays
+
+            batch = rt.RayBatch(arrays['points'], arrays['directions'],
+                                history=False)
+            batch._status[:] = arrays['status']
+            batch._opl[:] = arrays['opl']
+            batch._n[:] = arrays['n']
+
+            if history:
+                batch._history = list(arrays['history'])
+                batch._history_dirs = list(arrays['history_dirs'])
+
+        _freeze(batch)
+
+        return batch